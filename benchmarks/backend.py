@@ -0,0 +1,152 @@
+"""Load test of the frontend server's backend client
+
+Starts a stand-in backend on the local interface and measures latency of
+the resolve + pull pair of requests, which frontend server makes for every
+page view, using pooled `kinko.server.Backend` and using new session for
+every request (the way backend client worked before), and latency of the
+combined resolve-pull request.
+
+Usage::
+
+    python3 benchmarks/backend.py [-n REQUESTS] [-c CONCURRENCY]
+
+Requires Python 3.5+ and aiohttp 2.x or 3.x (it uses `make_handler`, which
+was removed in aiohttp 4).
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.environ.get('KINKO_PATH', os.path.dirname(_HERE)))
+
+from kinko.query import Edge, Field  # noqa
+from kinko.server import Backend  # noqa
+
+
+QUERY = Edge([Field('value')])
+
+
+async def _resolve(request):
+    return web.json_response({'status': 200, 'endpoint': 'a/foo'})
+
+
+async def _pull(request):
+    await request.read()
+    return web.Response(body=b'{"value" "test"}',
+                        headers={'Content-Type': 'application/edn'})
+
+
+async def _queries(request):
+    await request.read()
+    return web.Response()
+
+
+async def _resolve_pull(request):
+    return web.Response(body=b'{"value" "test"}',
+                        headers={'Content-Type': 'application/edn',
+                                 'X-Kinko-Status': '200',
+                                 'X-Kinko-Endpoint': 'a/foo'})
+
+
+class UnpooledBackend(Backend):
+    """Creates new session for every request"""
+
+    def __init__(self, base_url, *, loop):
+        super().__init__(base_url, loop=loop)
+        self._base_url = base_url
+
+    async def resolve(self, url):
+        backend = Backend(self._base_url, loop=self.loop)
+        try:
+            return await backend.resolve(url)
+        finally:
+            await backend.close()
+
+    async def pull(self, query, url):
+        backend = Backend(self._base_url, loop=self.loop)
+        try:
+            return await backend.pull(query, url)
+        finally:
+            await backend.close()
+
+
+class CombinedBackend(Backend):
+    """Resolves and pulls in a single request"""
+
+    async def resolve(self, url):
+        await self.resolve_pull(url)
+
+    async def pull(self, query, url):
+        pass
+
+
+async def _page_view(backend):
+    start = time.perf_counter()
+    await backend.resolve('/')
+    await backend.pull(QUERY, '/')
+    return time.perf_counter() - start
+
+
+async def _run(backend, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def view():
+        async with semaphore:
+            return await _page_view(backend)
+
+    await _page_view(backend)  # warm up
+    latencies = await asyncio.gather(*[view() for _ in range(requests)])
+    await backend.close()
+    return sorted(latencies)
+
+
+def _report(name, latencies):
+    def ms(value):
+        return '{:.2f}ms'.format(value * 1000)
+    print('{:<10} mean {}  p50 {}  p99 {}'.format(
+        name,
+        ms(sum(latencies) / len(latencies)),
+        ms(latencies[len(latencies) // 2]),
+        ms(latencies[int(len(latencies) * 0.99)]),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', dest='requests', type=int, default=2000)
+    parser.add_argument('-c', dest='concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/resolve', _resolve)
+    app.router.add_route('POST', '/pull', _pull)
+    app.router.add_route('POST', '/queries', _queries)
+    app.router.add_route('GET', '/resolve-pull', _resolve_pull)
+    handler = app.make_handler()
+    server = loop.run_until_complete(
+        loop.create_server(handler, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    base_url = 'http://127.0.0.1:{}/'.format(port)
+
+    try:
+        for name, cls in [('unpooled', UnpooledBackend),
+                          ('pooled', Backend),
+                          ('combined', CombinedBackend)]:
+            latencies = loop.run_until_complete(
+                _run(cls(base_url, loop=loop), args.requests,
+                     args.concurrency))
+            _report(name, latencies)
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(handler.shutdown())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Measures per-write overhead of the buffer implementations
+
+Usage: python benchmarks/buffers.py
+"""
+import sys
+import timeit
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from kinko.utils import Buffer, ListBuffer  # noqa
+
+
+WRITES = 1000
+REPEAT = 5
+NUMBER = 200
+
+VALUES = {
+    'write': u'<div class="item">',
+    'write_unsafe': u'Value & <value>',
+    'write_optional': None,
+}
+
+
+def render(buffer_cls, method):
+    value = VALUES[method]
+
+    def run():
+        buf = buffer_cls()
+        buf.push()
+        write = getattr(buf, method)
+        for _ in range(WRITES):
+            write(value)
+        buf.pop()
+    return run
+
+
+def main():
+    print('{:<16} {:<12} {:>12}'.format('method', 'buffer', 'ns/write'))
+    for method in sorted(VALUES):
+        for buffer_cls in [Buffer, ListBuffer]:
+            timings = timeit.repeat(render(buffer_cls, method),
+                                    repeat=REPEAT, number=NUMBER)
+            per_write = min(timings) / NUMBER / WRITES * 1e9
+            print('{:<16} {:<12} {:>12.1f}'.format(method, buffer_cls.__name__,
+                                                   per_write))
+
+
+if __name__ == '__main__':
+    main()
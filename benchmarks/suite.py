@@ -0,0 +1,170 @@
+"""Benchmarks for every stage of the Python backend
+
+Measures tokenize, parse, check, compile and render stages separately for
+representative templates and reports operations per second and peak
+memory allocated during one operation (only on Python 3).
+
+Usage::
+
+    python benchmarks/suite.py [-k CASE] [--compare REV]
+
+With ``--compare`` the same suite is also run against the source tree
+from the specified git revision and results are printed side by side.
+"""
+import os
+import sys
+import json
+import timeit
+import shutil
+import os.path
+import tempfile
+import argparse
+import subprocess
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_ROOT = os.path.dirname(_HERE)
+
+sys.path.insert(0, os.environ.get('KINKO_PATH', _ROOT))
+sys.path.insert(1, _HERE)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from kinko.lookup import Lookup  # noqa
+from kinko.loaders import DictLoader  # noqa
+from kinko.parser import parse  # noqa
+from kinko.tokenizer import tokenize  # noqa
+from kinko.compile.python import compile_module  # noqa
+
+try:
+    from kinko.lookup import COMPILE_OPTIONS  # noqa
+except ImportError:
+    # old revisions, measured with --compare, have no compiler options
+    COMPILE_OPTIONS = {}
+
+from templates import CASES  # noqa
+
+
+STAGES = ['tokenize', 'parse', 'check', 'compile', 'render']
+
+MIN_TIME = 0.2
+REPEAT = 3
+
+
+def _stages(case):
+    lookup = Lookup(case.types, DictLoader(case.sources))
+    root = case.function.partition('/')[0]
+    contents = list(case.sources.values())
+    tokens = [list(tokenize(content)) for content in contents]
+    parsed_sources = list(lookup._load_sources(root))
+    checked_sources, _ = lookup._check(parsed_sources)
+    fn = lookup.get(case.function)
+
+    def compile_():
+        for cs in checked_sources:
+            # the same options, which lookup uses
+            module = compile_module(cs.node, **COMPILE_OPTIONS)
+            compile(module, '<benchmark>', 'exec')
+
+    return {
+        'tokenize': lambda: [list(tokenize(c)) for c in contents],
+        'parse': lambda: [parse(t) for t in tokens],
+        'check': lambda: lookup._check(parsed_sources),
+        'compile': compile_,
+        'render': lambda: fn.render(case.result),
+    }
+
+
+def _measure(func):
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2
+    best = min(timeit.repeat(func, number=number, repeat=REPEAT))
+    ops = number / best
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'ops': ops, 'peak': peak}
+
+
+def run(names):
+    results = {}
+    for name in names:
+        stages = _stages(CASES[name])
+        results[name] = {stage: _measure(stages[stage]) for stage in STAGES}
+    return results
+
+
+def _run_revision(rev, names):
+    path = tempfile.mkdtemp()
+    try:
+        archive = subprocess.Popen(['git', 'archive', rev, 'kinko'],
+                                   cwd=_ROOT, stdout=subprocess.PIPE)
+        subprocess.check_call(['tar', '-x', '-C', path],
+                              stdin=archive.stdout)
+        if archive.wait() != 0:
+            raise RuntimeError('Failed to export revision {}'.format(rev))
+        env = dict(os.environ, KINKO_PATH=path)
+        args = [sys.executable, os.path.abspath(__file__), '--json']
+        for name in names:
+            args.extend(['-k', name])
+        output = subprocess.check_output(args, env=env)
+        return json.loads(output.decode('utf-8'))
+    finally:
+        shutil.rmtree(path)
+
+
+def _format_peak(peak):
+    return '-' if peak is None else '{:.1f}'.format(peak / 1024.0)
+
+
+def report(results, base=None):
+    header = '{:<24} {:<9} {:>12} {:>10}'.format('case', 'stage', 'ops/sec',
+                                                 'peak KiB')
+    if base is not None:
+        header += ' {:>12} {:>8}'.format('base ops/sec', 'change')
+    print(header)
+    for name in sorted(results):
+        for stage in STAGES:
+            value = results[name][stage]
+            line = '{:<24} {:<9} {:>12.1f} {:>10}'.format(
+                name, stage, value['ops'], _format_peak(value['peak']),
+            )
+            if base is not None:
+                base_ops = base[name][stage]['ops']
+                line += ' {:>12.1f} {:>+7.1f}%'.format(
+                    base_ops, (value['ops'] / base_ops - 1) * 100,
+                )
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='cases', action='append',
+                        choices=sorted(CASES), help='case to run')
+    parser.add_argument('--compare', metavar='REV',
+                        help='git revision to compare with')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+
+    names = args.cases or sorted(CASES)
+    base = _run_revision(args.compare, names) if args.compare else None
+    results = run(names)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        report(results, base)
+
+
+if __name__ == '__main__':
+    main()
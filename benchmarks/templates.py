@@ -0,0 +1,108 @@
+"""Representative templates for benchmarks
+
+Every case is a tuple of sources mapping, types, result and name of the
+function to render.
+"""
+from collections import namedtuple
+
+from kinko.types import StringType, IntType, ListType, Record
+
+
+Case = namedtuple('Case', 'sources types result function')
+
+ITEMS_COUNT = 1000
+NESTING_DEPTH = 30
+
+ITEM_TYPE = Record[{'id': IntType, 'name': StringType, 'kind': StringType}]
+
+TYPES = {
+    'title': StringType,
+    'items': ListType[ITEM_TYPE],
+}
+
+RESULT = {
+    'title': 'Benchmark <page>',
+    'items': [{'id': i, 'name': 'Item & {}'.format(i), 'kind': 'kind-{}'
+               .format(i % 3)}
+              for i in range(ITEMS_COUNT)],
+}
+
+
+def _deep_nesting():
+    lines = ['def page']
+    for level in range(NESTING_DEPTH):
+        lines.append('  ' * (level + 1) +
+                     'div :class "level-{}" :id "node-{}"'.format(level, level))
+    lines.append('  ' * (NESTING_DEPTH + 1) + 'span title')
+    return '\n'.join(lines) + '\n'
+
+
+LOOP_SRC = """\
+def page
+  div
+    h1 title
+    ul :class "items"
+      each item items
+        li :class item.kind :id item.id
+          span item.name
+          span :class "id" item.id
+"""
+
+JOINS_SRC = """\
+def page
+  div
+    each item items
+      div :class (join " " ["item" item.kind "x"])
+        a :href (join "/" ["" "items" item.kind item.name])
+          (join ", " [item.name item.kind title])
+"""
+
+CALLS_SRC = """\
+def page
+  div
+    h1 title
+    ul
+      each item items
+        widgets/item
+          :name item.name
+          :kind item.kind
+          :body
+            widgets/badge :text item.kind
+"""
+
+WIDGETS_SRC = """\
+def item
+  li :class #kind
+    span #name
+    #body
+
+def badge
+  span :class "badge"
+    #text
+"""
+
+LOCAL_CALLS_SRC = """\
+def page
+  div
+    h1 title
+    ul
+      each entry items
+        ./item
+          :name entry.name
+          :kind entry.kind
+          :body
+            ./badge :text entry.kind
+
+""" + WIDGETS_SRC
+
+
+CASES = {
+    'deep-nesting': Case({'main': _deep_nesting()}, TYPES, RESULT,
+                         'main/page'),
+    'large-loop': Case({'main': LOOP_SRC}, TYPES, RESULT, 'main/page'),
+    'many-joins': Case({'main': JOINS_SRC}, TYPES, RESULT, 'main/page'),
+    'cross-namespace-calls': Case({'main': CALLS_SRC, 'widgets': WIDGETS_SRC},
+                                  TYPES, RESULT, 'main/page'),
+    'local-calls': Case({'main': LOCAL_CALLS_SRC}, TYPES, RESULT,
+                        'main/page'),
+}
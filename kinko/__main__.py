@@ -23,8 +23,8 @@ class InputFile(click.File):
 
 
 COMPILERS = {
-    'py': 'kinko.out.py.compiler',
-    'js': 'kinko.out.js.incremental_dom',
+    'py': 'kinko.compile.python',
+    'js': 'kinko.compile.incremental_dom',
 }
 
 
@@ -94,6 +94,33 @@ def compile_(ctx, type_, source, output):
         output.write(compiler.dumps(module))
 
 
+@cli.command('build')
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+@click.argument('output', type=click.Path(file_okay=False))
+@click.option('-t', '--types', type=click.File(encoding='utf-8'))
+@click.option('-j', '--jobs', type=int,
+              help='Number of parallel processes, number of CPUs by default')
+@click.pass_context
+def build(ctx, path, output, types, jobs):
+    """Compile every Kinko namespace in the directory.
+
+    Compiled namespaces are stored as Python modules along with precomputed
+    queries, so they can be used without compilation at runtime."""
+    from .build import build
+    from .errors import UserError
+
+    try:
+        names = build(path, output, types.read() if types else None,
+                      jobs=jobs)
+    except UserError as e:
+        click.echo(str(e), err=True)
+        maybe_exit(ctx)
+        raise
+    else:
+        if ctx.obj.verbose:
+            click.echo('Compiled {} namespaces'.format(len(names)), err=True)
+
+
 @cli.command('convert')
 @click.argument('input', type=InputFile(encoding='utf-8'))
 @click.argument('output', type=click.File(mode='w+', encoding='utf-8'),
@@ -136,7 +163,45 @@ def render(path, name, output, types, result):
 @click.argument('ui_path', type=click.Path(exists=True, file_okay=False))
 @click.option('--static', type=click.Path(exists=True, file_okay=False))
 @click.option('--extend', multiple=True)
-def frontend(bind, base_url, ui_path, static, extend):
+@click.option('--cache', type=click.Path(file_okay=False),
+              help='Directory to store compiled templates')
+@click.option('--check-interval', type=float,
+              help='Check templates for modifications at most once per '
+                   'specified number of seconds')
+@click.option('--immutable', is_flag=True,
+              help='Never check templates for modifications')
+@click.option('--watch', is_flag=True,
+              help='Watch templates for modifications in background')
+@click.option('--compiled', type=click.Path(exists=True, file_okay=False),
+              help='Use templates, compiled by the "build" command')
+@click.option('--backend-pool-size', type=int, default=100,
+              show_default=True,
+              help='Maximum number of connections to the backend')
+@click.option('--backend-keepalive', type=float, default=30,
+              show_default=True,
+              help='Seconds to keep idle connections to the backend open')
+@click.option('--backend-timeout', type=float,
+              help='Timeout in seconds for connecting to the backend and '
+                   'for reading its responses')
+@click.option('--no-combined', is_flag=True,
+              help='Never resolve url and pull data in a single request')
+@click.option('--resolve-cache-size', type=int, default=1024,
+              show_default=True,
+              help='Maximum number of cached url resolution results, '
+                   '0 disables cache')
+@click.option('--resolve-ttl', type=float, default=60, show_default=True,
+              help='Seconds to cache url resolution results, when backend '
+                   'gives no Cache-Control hints')
+@click.option('--resolve-negative-ttl', type=float, default=10,
+              show_default=True,
+              help='Seconds to cache "not found" url resolution results')
+@click.option('--render-cache', type=int, metavar='MEGABYTES',
+              help='Cache rendered pages and answer conditional requests, '
+                   'using at most specified amount of memory')
+def frontend(bind, base_url, ui_path, static, extend, cache, check_interval,
+             immutable, watch, compiled, backend_pool_size, backend_keepalive,
+             backend_timeout, no_combined, resolve_cache_size, resolve_ttl,
+             resolve_negative_ttl, render_cache):
     """Run frontend server.
 
     Frontend server talks with backend server via special API
@@ -149,7 +214,14 @@ def frontend(bind, base_url, ui_path, static, extend):
 
     host, _, port = bind.partition(':')
     main(host, int(port), base_url, ui_path, static,
-         extensions=extend)
+         extensions=extend, cache_path=cache, check_interval=check_interval,
+         immutable=immutable, watch=watch, compiled_path=compiled,
+         backend_pool_size=backend_pool_size,
+         backend_keepalive=backend_keepalive,
+         backend_timeout=backend_timeout, combined=not no_combined,
+         resolve_cache_size=resolve_cache_size, resolve_ttl=resolve_ttl,
+         resolve_negative_ttl=resolve_negative_ttl,
+         render_cache_size=render_cache and render_cache * 1024 * 1024)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+"""Ahead-of-time compilation of the whole UI directory
+
+Build directory contains Python module for every namespace and an index
+with dependencies of the namespaces and precomputed queries, it is loaded
+by the :py:class:`CompiledLookup`.
+"""
+import re
+import sys
+import os.path
+import pickle
+import multiprocessing
+from itertools import chain
+
+from .errors import UserError
+from .utils import Buffer
+from .compat import text_type
+from .lookup import Lookup, Namespace, COMPILE_OPTIONS
+from .modules import module_name, path_key, import_path
+from .loaders import FileSystemLoader, NamespaceNotFound
+from .typedef import load_types
+from .compile.python import compile_module, dumps
+
+
+INDEX_FILE_NAME = 'index.pickle'
+
+# bump this version every time when build directory format changes
+BUILD_VERSION = 14
+
+_MODULE_HEADER = '# -*- coding: utf-8 -*-\n# Generated by Kinko, do not edit\n'
+
+# parser and type checker state, forked worker processes inherit it
+_lookup = None
+_parsed = {}
+_checked = {}
+
+
+def _init(ui_path, types_content):
+    global _lookup
+    types = load_types(types_content) if types_content else {}
+    _lookup = Lookup(types, FileSystemLoader(ui_path, immutable=True))
+    _parsed.clear()
+    _checked.clear()
+
+
+def _parse_all(names):
+    visited = set([])
+    parsed_sources = []
+    for name in names:
+        try:
+            parsed_sources.extend(_lookup._load_sources(name,
+                                                        _visited=visited))
+        except NamespaceNotFound as e:
+            raise UserError('Namespace "{}" is not found'.format(e.args[0]))
+    return parsed_sources
+
+
+def _check(names):
+    """Checks namespaces, which depend only on each other, and stores them
+    for compilation
+    """
+    checked_sources, reqs = _lookup._check([_parsed[name] for name in names])
+    for cs in checked_sources:
+        _checked[cs.name] = cs, reqs
+
+
+def _compile(name):
+    cs, reqs = _checked[name]
+    source = dumps(compile_module(cs.node, **COMPILE_OPTIONS))
+    ns_reqs = {key: value for key, value in reqs.items()
+               if key.partition('/')[0] == cs.name}
+    return cs.name, source, sorted(cs.dependencies), ns_reqs
+
+
+def _compile_component(names):
+    """Checks and compiles namespaces, which depend only on each other
+
+    Returns compiled namespaces or an error message.
+    """
+    try:
+        _check(names)
+    except UserError as e:
+        return None, text_type(e)
+    return [_compile(name) for name in names], None
+
+
+def _fork_pool(processes):
+    """Returns pool of the forked processes, which inherit parsed and
+    checked namespaces, or None when fork is not available
+    """
+    if hasattr(multiprocessing, 'get_all_start_methods'):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        return multiprocessing.get_context('fork').Pool(processes)
+    elif sys.platform == 'win32':
+        return None
+    return multiprocessing.Pool(processes)
+
+
+def _map(fn, items, jobs):
+    pool = _fork_pool(min(jobs, len(items))) if jobs > 1 else None
+    if pool is None:
+        return list(map(fn, items))
+    try:
+        # chunksize=1 to balance large items between processes
+        return pool.map(fn, items, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def components(graph):
+    """Splits namespaces dependencies graph into independent components
+
+    Namespaces from different components do not depend on each other, so
+    they can be checked and compiled separately. Components are returned in
+    deterministic order, largest first.
+    """
+    adjacent = {name: set(deps) for name, deps in graph.items()}
+    for name, deps in graph.items():
+        for dep in deps:
+            adjacent.setdefault(dep, set()).add(name)
+    result = []
+    visited = set([])
+    for name in sorted(adjacent):
+        if name in visited:
+            continue
+        component = []
+        queue = [name]
+        visited.add(name)
+        while queue:
+            item = queue.pop()
+            component.append(item)
+            for other in adjacent[item]:
+                if other not in visited:
+                    visited.add(other)
+                    queue.append(other)
+        result.append(sorted(component))
+    return sorted(result, key=lambda c: (-len(c), c))
+
+
+def _module_names(names):
+    modules = {}
+    used = set()
+    for name in names:
+        module = re.sub(r'\W', '_', name)
+        if not re.match(r'[^\d\W]', module):
+            module = '_' + module
+        candidate, i = module, 1
+        while candidate in used:
+            i += 1
+            candidate = '{}_{}'.format(module, i)
+        used.add(candidate)
+        modules[name] = candidate
+    return modules
+
+
+def _compile_all(ui_path, types_content, names, jobs):
+    _init(ui_path, types_content)
+    _parsed.update((ps.name, ps) for ps in _parse_all(names))
+    parts = components({name: ps.dependencies
+                        for name, ps in _parsed.items()})
+    if len(parts) > 1:
+        return _map(_compile_component, parts, jobs)
+    # usually all namespaces depend on the common ones, so there is only one
+    # component, it is checked at once and then namespaces are compiled in
+    # parallel
+    part, = parts or [[]]
+    try:
+        _check(part)
+    except UserError as e:
+        return [(None, text_type(e))]
+    return [(_map(_compile, part, jobs), None)]
+
+
+def build(ui_path, output_path, types_content=None, jobs=None):
+    """Compiles every namespace from the `ui_path` into `output_path`
+
+    Sources are parsed once and namespaces dependencies graph is split into
+    independent components, which are checked and compiled in parallel
+    using `jobs` forked processes (by default number of CPUs is used). When
+    there is only one component, it is checked at once and then namespaces
+    are compiled in parallel. Returns list of compiled namespaces.
+    """
+    names = FileSystemLoader(ui_path).list()
+    results = _compile_all(ui_path, types_content, names,
+                           jobs or multiprocessing.cpu_count())
+
+    errors = [error for _, error in results if error is not None]
+    if errors:
+        raise UserError('\n'.join(errors))
+    compiled = sorted(chain.from_iterable(c for c, _ in results))
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    modules = _module_names([name for name, _, _, _ in compiled])
+    index = {'version': BUILD_VERSION, 'namespaces': {}, 'queries': {}}
+    for name, source, dependencies, reqs in compiled:
+        file_path = os.path.join(output_path, modules[name] + '.py')
+        with open(file_path, 'wb') as f:
+            f.write((_MODULE_HEADER + source).encode('utf-8'))
+        index['namespaces'][name] = {'module': modules[name],
+                                     'dependencies': dependencies}
+        index['queries'].update(reqs)
+
+    with open(os.path.join(output_path, '__init__.py'), 'wb'):
+        pass
+    with open(os.path.join(output_path, INDEX_FILE_NAME), 'wb') as f:
+        pickle.dump(index, f, 2)
+    return [name for name, _, _, _ in compiled]
+
+
+class CompiledLookup(Lookup):
+    """Lookup for the namespaces, compiled ahead of time using `build`
+
+    It never runs tokenizer, parser, type checker or compiler, and never
+    checks templates for modifications.
+    """
+
+    def __init__(self, path, builtins=None, buffer_cls=Buffer,
+                 render_cache=None, fragments=None):
+        if fragments is not None:
+            raise ValueError('Fragments are not supported by the compiled '
+                             'lookup')
+        super(CompiledLookup, self).__init__({}, None, builtins=builtins,
+                                             buffer_cls=buffer_cls,
+                                             render_cache=render_cache)
+        self._path = path
+        with open(os.path.join(path, INDEX_FILE_NAME), 'rb') as f:
+            index = pickle.load(f)
+        if index['version'] != BUILD_VERSION:
+            raise ValueError('Incompatible build version: {!r}'
+                             .format(index['version']))
+        self._index = index['namespaces']
+        self._reqs = index['queries']
+
+    def _names(self):
+        return sorted(self._index)
+
+    def _load(self, name):
+        if name in self._namespaces:
+            return
+        try:
+            info = self._index[name]
+        except KeyError:
+            raise NamespaceNotFound(name)
+        file_path = os.path.join(self._path, info['module'] + '.py')
+        try:
+            module = import_path(module_name(name, path_key(file_path)),
+                                 file_path)
+        except (IOError, OSError):
+            raise UserError('Module of the namespace "{}" is missing in the '
+                            'build: {}'.format(name, file_path))
+        self._namespaces[name] = Namespace(name, None, None, vars(module),
+                                           set(info['dependencies']),
+                                           None, None)
+        try:
+            for dep in info['dependencies']:
+                try:
+                    self._load(dep)
+                except NamespaceNotFound:
+                    raise UserError('Namespace "{}", required by "{}", is '
+                                    'missing in the build'.format(dep, name))
+        except UserError:
+            del self._namespaces[name]
+            raise
+        self._link({name})
@@ -26,6 +26,12 @@ if PY3:
 
     text_type = str
     text_type_name = 'str'
+    integer_types = (int,)
+    unichr = chr
+
+    from importlib.util import MAGIC_NUMBER
+
+    import queue
 
 else:
     from itertools import izip_longest as _zip_longest
@@ -35,6 +41,13 @@ else:
 
     text_type = unicode  # noqa
     text_type_name = 'unicode'
+    integer_types = (int, long)  # noqa
+    unichr = unichr  # noqa
+
+    from imp import get_magic as _get_magic
+    MAGIC_NUMBER = _get_magic()
+
+    import Queue as queue  # noqa
 
 
 zip_longest = _zip_longest
@@ -4,12 +4,14 @@ from .compat import PY3, PY35
 
 
 If = _ast.If
+Mod = _ast.Mod
 Str = _ast.Str
 Num = _ast.Num
 For = _ast.For
 Expr = _ast.Expr
 Name = _ast.Name
 Load = _ast.Load
+Pass = _ast.Pass
 List = _ast.List
 Index = _ast.Index
 Store = _ast.Store
@@ -17,6 +19,8 @@ IfExp = _ast.IfExp
 IsNot = _ast.IsNot
 Tuple = _ast.Tuple
 Module = _ast.Module
+BinOp = _ast.BinOp
+BoolOp = _ast.BoolOp
 Assign = _ast.Assign
 Compare = _ast.Compare
 ListComp = _ast.ListComp
@@ -1,17 +1,24 @@
 from __future__ import absolute_import, unicode_literals
 
-from ast import NodeTransformer, iter_fields, copy_location
+import re
+import string
+from ast import NodeTransformer, iter_fields, copy_location, walk
+from os.path import commonprefix
+from itertools import count
+from contextlib import contextmanager
+from collections import OrderedDict
 from ast import fix_missing_locations
 
 import astor
+from markupsafe import escape
 
 from .. import compat_ast as py
 from ..types import NamedArgMeta, VarArgsMeta, VarNamedArgsMeta, UnionMeta
-from ..types import StringTypeMeta, NothingMeta
-from ..nodes import String, Tuple, Symbol, List, Number, Placeholder
+from ..types import StringTypeMeta, NothingMeta, Markup
+from ..nodes import String, Tuple, Symbol, List, Number, Placeholder, Keyword
 from ..nodes import NodeVisitor
 from ..utils import Environ, split_args, normalize_args
-from ..compat import text_type, text_type_name
+from ..compat import text_type, text_type_name, unichr
 from ..checker import DEF_TYPE, HTML_TAG_TYPE
 from ..checker import IF1_TYPE, IF2_TYPE, EACH_TYPE, JOIN1_TYPE, JOIN2_TYPE
 from ..checker import GET_TYPE, get_type, returns_markup, IF3_TYPE
@@ -19,6 +26,34 @@ from ..checker import IF_SOME1_TYPE, IF_SOME2_TYPE, IF_SOME3_TYPE, LET_TYPE
 from ..constant import SELF_CLOSING_ELEMENTS
 
 
+LINK_PREFIX = '_l_'
+
+# suffix of the functions, which render content of the cacheable functions
+FRAGMENT_SUFFIX = '__fragment'
+
+_LINK_CHARS = frozenset(string.ascii_letters + string.digits)
+
+
+def _mangle(name):
+    return ''.join(c if c in _LINK_CHARS else '_{:x}_'.format(ord(c))
+                   for c in name)
+
+
+def link_name(name):
+    """Returns global variable name for the function from another namespace
+
+    These variables are bound by the lookup, when namespace is loaded.
+    """
+    return LINK_PREFIX + _mangle(name)
+
+
+def unlink_name(name):
+    """Returns function name from the global variable name"""
+    assert name.startswith(LINK_PREFIX), name
+    return re.sub(r'_([0-9a-f]+)_', lambda m: unichr(int(m.group(1), 16)),
+                  name[len(LINK_PREFIX):])
+
+
 def _contains_string(type_):
     def recur_check(t):
         if isinstance(t, UnionMeta):
@@ -62,6 +97,28 @@ def _write_str(value):
     return _write(py.Str(value))
 
 
+def _write_markup(value):
+    buffer = py.Attribute(py.Name('ctx', py.Load()), 'buffer', py.Load())
+    return py.Expr(py.Call(py.Attribute(buffer, 'write_markup', py.Load()),
+                           [value], [], None, None))
+
+
+def _render_fragment(name, impl_name, arg_names):
+    call = py.Call(py.Attribute(py.Name('ctx', py.Load()), 'fragment',
+                                py.Load()),
+                   [py.Str(name), py.Name(impl_name, py.Load()),
+                    py.Tuple([py.Name(arg, py.Load()) for arg in arg_names],
+                             py.Load())],
+                   [], None, None)
+    return py.Expr(call)
+
+
+def _render_markup(value):
+    buffer = py.Attribute(py.Name('ctx', py.Load()), 'buffer', py.Load())
+    return py.Call(py.Attribute(buffer, 'render_markup', py.Load()),
+                   [value], [], None, None)
+
+
 def _result_get(name):
     result = py.Attribute(py.Name('ctx', py.Load()), 'result', py.Load())
     return py.Subscript(result, py.Index(py.Str(name)), py.Load())
@@ -135,19 +192,80 @@ def _maybe_write(node):
             return text_type(node.value.args[0].n)
 
 
+_PURE_NODES = frozenset(['Name', 'Str', 'Num', 'NameConstant', 'Constant',
+                         'Attribute', 'Subscript', 'Index', 'Compare',
+                         'BoolOp', 'UnaryOp', 'Load', 'And', 'Or', 'Not',
+                         'Is', 'IsNot', 'Eq', 'NotEq', 'In', 'NotIn', 'Lt',
+                         'LtE', 'Gt', 'GtE'])
+
+
+def _pure(node):
+    """Returns True when expression only reads values, without calls"""
+    return all(n.__class__.__name__ in _PURE_NODES for n in walk(node))
+
+
+def _split_branches(node):
+    """Moves common leading and trailing literal writes out of the `if`
+    statement branches
+
+    Returns prefix, new `if` statement and suffix. When both branches are
+    equal, `if` statement is replaced with its test expression, or with
+    None if test is pure.
+    """
+    body, orelse = list(node.body), list(node.orelse)
+    prefix = suffix = ''
+
+    first = [_maybe_write(body[0]), _maybe_write(orelse[0])]
+    if None not in first:
+        prefix = commonprefix(first)
+        if prefix:
+            body[:1] = [_write_str(first[0][len(prefix):])]
+            orelse[:1] = [_write_str(first[1][len(prefix):])]
+
+    last = [_maybe_write(body[-1]), _maybe_write(orelse[-1])]
+    if None not in last:
+        suffix = commonprefix([i[::-1] for i in last])[::-1]
+        if suffix:
+            body[-1:] = [_write_str(last[0][:-len(suffix)])]
+            orelse[-1:] = [_write_str(last[1][:-len(suffix)])]
+
+    body = [i for i in body if _maybe_write(i) != '']
+    orelse = [i for i in orelse if _maybe_write(i) != '']
+    if body or orelse:
+        new_node = py.If(node.test, body or [py.Pass()], orelse)
+    elif _pure(node.test):
+        return prefix + suffix, None, ''
+    else:
+        new_node = py.Expr(node.test)
+    return prefix, copy_location(new_node, node), suffix
+
+
 class _Optimizer(NodeTransformer):
 
+    def __init__(self, merge_branches=False):
+        self.merge_branches = merge_branches
+
     def _paste(self, body):
         chunks = []
         for item in body:
             chunk = _maybe_write(item)
             if chunk is not None:
                 chunks.append(chunk)
+                continue
+            if self.merge_branches and _cls_eq(item, 'If') and item.orelse:
+                prefix, item, suffix = _split_branches(item)
             else:
-                if chunks:
-                    yield _write_str(''.join(chunks))
-                    del chunks[:]
-                yield item
+                prefix = suffix = ''
+            if prefix:
+                chunks.append(prefix)
+            if item is None:
+                continue
+            if chunks:
+                yield _write_str(''.join(chunks))
+                del chunks[:]
+            yield item
+            if suffix:
+                chunks.append(suffix)
         if chunks:
             yield _write_str(''.join(chunks))
 
@@ -169,6 +287,730 @@ class _Optimizer(NodeTransformer):
         node.body = list(self._paste(node.body))
 
 
+def _simple_expr(node):
+    if _cls_eq(node, 'Name') or _cls_eq(node, 'Num') or _cls_eq(node, 'Str'):
+        return True
+    elif _cls_eq(node, 'Attribute'):
+        return _simple_expr(node.value)
+    elif _cls_eq(node, 'Subscript'):
+        return (_simple_expr(node.value) and _cls_eq(node.slice, 'Index') and
+                _simple_expr(node.slice.value))
+    return False
+
+
+def _format_part(node):
+    """Returns literal text or value for the formatted write, or None"""
+    if not _cls_eq(node, 'Expr') or not _cls_eq(node.value, 'Call'):
+        return
+    call = node.value
+    if not _cls_eq(call.func, 'Attribute') or \
+            _ctx_attr(call.func.value) != 'buffer' or \
+            len(call.args) != 1 or call.keywords:
+        return
+    text = _maybe_write(node)
+    if text is not None:
+        return text, None
+    value, = call.args
+    if not _simple_expr(value):
+        return
+    if call.func.attr == 'write':
+        return None, value
+    elif call.func.attr == 'write_unsafe':
+        escape = py.Attribute(call.func.value, 'escape', py.Load())
+        return None, py.Call(escape, [value], [], None, None)
+
+
+class _FormattedWrites(NodeTransformer):
+    """Replaces sequences of writes with the single write of the formatted
+    string
+
+    Values are formatted using `%s`, values which need escaping are escaped
+    using `ctx.buffer.escape`, which doesn't allocate `Markup` objects.
+    """
+
+    def _format(self, parts):
+        if len(parts) < 2 or all(value is None for _, value in parts):
+            return [item for item, _ in parts]
+        template, values = [], []
+        for _, (text, value) in parts:
+            if value is None:
+                template.append(text.replace('%', '%%'))
+            else:
+                template.append('%s')
+                values.append(value)
+        buffer = py.Attribute(py.Name('ctx', py.Load()), 'buffer', py.Load())
+        formatted = py.BinOp(py.Str(''.join(template)), py.Mod(),
+                             py.Tuple(values, py.Load()))
+        return [py.Expr(py.Call(py.Attribute(buffer, 'write', py.Load()),
+                                [formatted], [], None, None))]
+
+    def _merge(self, body):
+        parts = []
+        for item in body:
+            part = _format_part(item)
+            if part is not None:
+                parts.append((item, part))
+            else:
+                for write in self._format(parts):
+                    yield write
+                del parts[:]
+                yield item
+        for write in self._format(parts):
+            yield write
+
+    @_node_copy
+    def visit_Module(self, node):
+        node.body = list(self._merge(node.body))
+
+    @_node_copy
+    def visit_FunctionDef(self, node):
+        node.body = list(self._merge(node.body))
+
+    @_node_copy
+    def visit_If(self, node):
+        node.body = list(self._merge(node.body))
+        node.orelse = list(self._merge(node.orelse))
+
+    @_node_copy
+    def visit_For(self, node):
+        node.body = list(self._merge(node.body))
+
+
+def _buf_flush():
+    buffer = py.Attribute(py.Name('ctx', py.Load()), 'buffer', py.Load())
+    return py.Expr(py.Call(py.Attribute(buffer, 'flush', py.Load()),
+                           [], [], None, None))
+
+
+class _FlushPoints(NodeTransformer):
+    """Adds points, where rendered content can be flushed
+
+    Content is flushed after every loop iteration and after every function
+    call, it is safe to do this at any point, buffer decides on its own
+    whether it can flush content or not.
+    """
+
+    @_node_copy
+    def visit_FunctionDef(self, node):
+        node.body = node.body + [_buf_flush()]
+
+    @_node_copy
+    def visit_For(self, node):
+        node.body = node.body + [_buf_flush()]
+
+
+def _ctx_attr(node):
+    if _cls_eq(node, 'Attribute') and _cls_eq(node.value, 'Name') and \
+            node.value.id == 'ctx':
+        return node.attr
+
+
+class _LocalsHoister(NodeTransformer):
+    """Binds context attributes, buffer methods and builtins, used in the
+    function, to the local variables at the beginning of the function
+
+    Builtins are hoisted only when they are used unconditionally or in the
+    loops, so missing builtin, used only in the branch, which is not taken,
+    or in the function, which is not called, doesn't fail.
+    """
+
+    def __init__(self):
+        self._locals = None
+        self._branches = 0
+
+    def _hoist(self, name, node):
+        if self._locals is None:
+            return node
+        self._locals.setdefault(name, node)
+        return py.Name(name, py.Load())
+
+    @contextmanager
+    def _branch(self):
+        self._branches += 1
+        try:
+            yield
+        finally:
+            self._branches -= 1
+
+    def _visit_all(self, nodes):
+        return [self.visit(node) for node in nodes]
+
+    def visit_FunctionDef(self, node):
+        if self._locals is not None:
+            # nested functions are using locals of the outer function
+            with self._branch():
+                return self.generic_visit(node)
+        self._locals = OrderedDict()
+        body = self._visit_all(node.body)
+        hoisted = [py.Assign([py.Name(name, py.Store())], value)
+                   for name, value in self._locals.items()]
+        self._locals = None
+        new_node = py.FunctionDef(node.name, node.args, hoisted + body,
+                                  node.decorator_list)
+        return copy_location(new_node, node)
+
+    def visit_If(self, node):
+        test = self.visit(node.test)
+        with self._branch():
+            new_node = py.If(test, self._visit_all(node.body),
+                             self._visit_all(node.orelse))
+        return copy_location(new_node, node)
+
+    def visit_IfExp(self, node):
+        test = self.visit(node.test)
+        with self._branch():
+            new_node = py.IfExp(test, self.visit(node.body),
+                                self.visit(node.orelse))
+        return copy_location(new_node, node)
+
+    def visit_BoolOp(self, node):
+        values = [self.visit(node.values[0])]
+        with self._branch():
+            values.extend(self._visit_all(node.values[1:]))
+        return copy_location(py.BoolOp(node.op, values), node)
+
+    def visit_Attribute(self, node):
+        if _ctx_attr(node.value) == 'buffer':
+            return self._hoist('_ctx_buffer_{}'.format(node.attr), node)
+        elif _ctx_attr(node) == 'result':
+            return self._hoist('_ctx_result', node)
+        return self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if _ctx_attr(node.value) == 'builtins' and \
+                _cls_eq(node.slice, 'Index') and \
+                _cls_eq(node.slice.value, 'Str'):
+            if self._branches:
+                return node
+            name = '_ctx_builtins_{}'.format(_mangle(node.slice.value.s))
+            return self._hoist(name, node)
+        return self.generic_visit(node)
+
+
+_undefined = object()
+
+_IF_TYPES = (IF1_TYPE, IF2_TYPE, IF3_TYPE)
+
+
+def _norm_args(node):
+    sym, args = node.values[0], node.values[1:]
+    pos_args, kw_args = split_args(args)
+    return sym, normalize_args(sym.__type__, pos_args, kw_args)
+
+
+def _replace(node, replacements):
+    return node.clone_with(replacements.get(id(value), value)
+                           for value in node.values)
+
+
+def _literal(value, node=None):
+    kw = {} if node is None else {'location': node.location,
+                                  'type': node.__type__}
+    if isinstance(value, text_type):
+        return String(value, **kw)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return Number(value, **kw)
+    elif isinstance(value, list):
+        items = [_literal(i) for i in value]
+        if None not in items:
+            return List(items, **kw)
+
+
+class _ConstantFolder(object):
+    """Prerenders subtrees, which do not depend on the result data or
+    function arguments, into string literals
+
+    Content of the node in the write position is rendered in the same way,
+    as it will be written into the buffer by the compiled code. Results are
+    cached, because every node is evaluated within the only one scope.
+    """
+
+    def __init__(self):
+        self._scopes = [{}]
+        self._values = {}
+        self._texts = {}
+
+    def _cached(self, cache, method, node):
+        try:
+            return cache[id(node)][1]
+        except KeyError:
+            result = method(node)
+            cache[id(node)] = (node, result)
+            return result
+
+    @contextmanager
+    def _scope(self, consts):
+        self._scopes.append(consts)
+        try:
+            yield
+        finally:
+            self._scopes.pop()
+
+    def _const(self, name):
+        for scope in reversed(self._scopes):
+            if name in scope:
+                return scope[name]
+        return _undefined
+
+    def _branch(self, type_, norm_args):
+        test = self.value(norm_args[0])
+        if test is _undefined:
+            return _undefined
+        elif type_ is IF1_TYPE:
+            return norm_args[1] if test else None
+        else:
+            return norm_args[1] if test else norm_args[2]
+
+    def _bindings(self, bindings):
+        names, values = bindings.values[::2], bindings.values[1::2]
+        values = [_undefined if returns_markup(value) else self.value(value)
+                  for value in values]
+        return dict(zip([sym.name for sym in names], values))
+
+    def value(self, node):
+        """Returns value of the constant expression or `_undefined`"""
+        return self._cached(self._values, self._value, node)
+
+    def _value(self, node):
+        if isinstance(node, (String, Number)):
+            return node.value
+        elif isinstance(node, Symbol):
+            return self._const(node.name)
+        elif isinstance(node, List):
+            values = [self.value(value) for value in node.values]
+            if not any(value is _undefined for value in values):
+                return values
+        elif isinstance(node, Tuple) and not returns_markup(node):
+            sym, norm_args = _norm_args(node)
+            if sym.__type__ is JOIN2_TYPE:
+                sep, values = [self.value(arg) for arg in norm_args]
+                if isinstance(sep, text_type) and isinstance(values, list):
+                    return sep.join(text_type(value) for value in values)
+            elif sym.__type__ in _IF_TYPES:
+                branch = self._branch(sym.__type__, norm_args)
+                if branch is None:
+                    return None
+                elif branch is not _undefined:
+                    return self.value(branch)
+            elif sym.__type__ is LET_TYPE:
+                bindings, expr = norm_args
+                consts = self._bindings(bindings)
+                if _undefined not in consts.values():
+                    with self._scope(consts):
+                        return self.value(expr)
+        return _undefined
+
+    def text(self, node):
+        """Returns rendered content of the node in the write position or
+        None, when it can't be rendered during compilation
+        """
+        return self._cached(self._texts, self._text, node)
+
+    def _text(self, node):
+        if isinstance(node, String):
+            return node.value
+        elif isinstance(node, Number):
+            return text_type(node.value)
+        elif isinstance(node, Tuple) and node.values[0].__type__ is DEF_TYPE:
+            return None
+        elif not returns_markup(node):
+            value = self.value(node)
+            if value is None and _contains_optional(get_type(node)):
+                return ''
+            elif value is None or value is _undefined or \
+                    isinstance(value, list):
+                return None
+            elif _contains_string(get_type(node)):
+                return text_type(escape(value))
+            else:
+                return text_type(value)
+        elif isinstance(node, Tuple):
+            sym, norm_args = _norm_args(node)
+            if sym.__type__ is HTML_TAG_TYPE:
+                return self._tag_text(sym.name, *norm_args)
+            elif sym.__type__ is JOIN1_TYPE:
+                col, = norm_args
+                return self._join_text(col.values)
+            elif sym.__type__ in _IF_TYPES:
+                branch = self._branch(sym.__type__, norm_args)
+                if branch is None:
+                    return ''
+                elif branch is not _undefined:
+                    return self.text(branch)
+            elif sym.__type__ is LET_TYPE:
+                bindings, expr = norm_args
+                consts = self._bindings(bindings)
+                if _undefined not in consts.values():
+                    with self._scope(consts):
+                        return self.text(expr)
+        return None
+
+    def _join_text(self, values):
+        chunks = [self.text(value) for value in values]
+        if None not in chunks:
+            return ''.join(chunks)
+
+    def _tag_text(self, tag_name, attrs, body):
+        if tag_name in SELF_CLOSING_ELEMENTS and body:
+            return None
+        chunks = ['<{}'.format(tag_name)]
+        for key, value in attrs.items():
+            chunks.extend([' {}="'.format(key), self.text(value), '"'])
+        if tag_name in SELF_CLOSING_ELEMENTS:
+            chunks.append('/>')
+        else:
+            chunks.extend(['>', self._join_text(body),
+                           '</{}>'.format(tag_name)])
+        if None not in chunks:
+            return ''.join(chunks)
+
+    def fold(self, node, write=False):
+        """Returns node with prerendered and evaluated constant subtrees"""
+        if isinstance(node, (String, Number)):
+            return node
+        elif write or returns_markup(node):
+            text = self.text(node)
+            if text is not None:
+                return String(text, location=node.location, type=Markup)
+        else:
+            literal = _literal(self.value(node), node)
+            if literal is not None:
+                return literal
+        if isinstance(node, Tuple):
+            return self._fold_tuple(node, write)
+        return node
+
+    def _fold_tuple(self, node, write):
+        sym, norm_args = _norm_args(node)
+        type_ = sym.__type__
+        replacements = {}
+
+        if type_ is DEF_TYPE:
+            _, body = norm_args
+            replacements[id(body)] = self.fold(body, True)
+
+        elif type_ is HTML_TAG_TYPE:
+            attrs, body = norm_args
+            for value in list(attrs.values()) + list(body):
+                replacements[id(value)] = self.fold(value, True)
+
+        elif type_ is JOIN1_TYPE:
+            col, = norm_args
+            replacements[id(col)] = col.clone_with(self.fold(value, True)
+                                                   for value in col.values)
+
+        elif type_ in _IF_TYPES:
+            branch = self._branch(type_, norm_args)
+            if branch is not None and branch is not _undefined:
+                return self.fold(branch, write)
+            test, branches = norm_args[0], norm_args[1:]
+            replacements[id(test)] = self.fold(test)
+            for branch in branches:
+                replacements[id(branch)] = self.fold(branch, write)
+
+        elif type_ is LET_TYPE:
+            bindings, expr = norm_args
+            names, values = bindings.values[::2], bindings.values[1::2]
+            values = [self.fold(value) for value in values]
+            consts, rest = {}, []
+            for name, value in zip(names, values):
+                const = _undefined
+                if not returns_markup(value):
+                    const = self.value(value)
+                if _literal(const) is None:
+                    consts[name.name] = _undefined
+                    rest.extend([name, value])
+                else:
+                    consts[name.name] = const
+            with self._scope(consts):
+                expr_node = self.fold(expr, write)
+            if not rest:
+                return expr_node
+            replacements[id(bindings)] = bindings.clone_with(rest)
+            replacements[id(expr)] = expr_node
+
+        elif type_ in (IF_SOME1_TYPE, IF_SOME2_TYPE, IF_SOME3_TYPE):
+            bind, branches = norm_args[0], norm_args[1:]
+            name, value = bind.values
+            replacements[id(bind)] = bind.clone_with([name, self.fold(value)])
+            with self._scope({name.name: _undefined}):
+                for branch in branches:
+                    replacements[id(branch)] = self.fold(branch, write)
+
+        elif type_ is EACH_TYPE:
+            var, col, body = norm_args
+            replacements[id(col)] = self.fold(col)
+            with self._scope({var.name: _undefined}):
+                replacements[id(body)] = self.fold(body, True)
+
+        elif type_ is not GET_TYPE:
+            for arg_type, arg in zip(type_.__args__, norm_args):
+                if isinstance(arg_type, VarArgsMeta):
+                    args = arg
+                elif isinstance(arg_type, VarNamedArgsMeta):
+                    args = arg.values()
+                else:
+                    args = [arg]
+                for value in args:
+                    replacements[id(value)] = self.fold(value)
+
+        else:
+            obj, _ = norm_args
+            replacements[id(obj)] = self.fold(obj)
+
+        return _replace(node, replacements)
+
+
+INLINE_THRESHOLD = 40
+
+
+class _NodesCounter(NodeVisitor):
+
+    def __init__(self):
+        self.count = 0
+
+    def visit(self, node):
+        self.count += 1
+        super(_NodesCounter, self).visit(node)
+
+
+def _def_body(node):
+    if isinstance(node, Tuple) and node.values[0].__type__ is DEF_TYPE:
+        _, (name, body) = _norm_args(node)
+        return name.name, body
+
+
+class _Substitution(object):
+    """Substitutes function arguments into the function body
+
+    `params` maps names of the arguments to the symbols, which are bound to
+    their values. Variables, bound in the function body, are renamed to
+    avoid capturing of the substituted markup arguments. `failed` is set,
+    when markup argument can't be substituted: when it is used more than
+    once, inside of a loop or in the position, where it can't be written
+    directly.
+    """
+
+    def __init__(self, params, markup, counter):
+        self.params = params
+        self.markup = markup
+        self.free = set()
+        self.failed = False
+        self._counter = counter
+        self._scopes = [{}]
+        self._used = set()
+
+    @contextmanager
+    def _scope(self, names):
+        scope = {sym.name: '{}__{}'.format(sym.name, next(self._counter))
+                 for sym in names}
+        self._scopes.append(scope)
+        try:
+            yield scope
+        finally:
+            self._scopes.pop()
+
+    def visit(self, node, write=False, loop=False):
+        if isinstance(node, Placeholder):
+            if node.name in self.markup:
+                if node.name in self._used or not write or loop:
+                    self.failed = True
+                self._used.add(node.name)
+                return self.markup[node.name]
+            elif node.name in self.params:
+                # bound symbol has type of the value, not of the parameter,
+                # so constant folding treats it as the bound value
+                param = self.params[node.name]
+                return Symbol(param.name, location=node.location,
+                              type=param.__type__)
+            self.failed = True
+            return node
+        elif isinstance(node, Symbol):
+            for scope in reversed(self._scopes):
+                if node.name in scope:
+                    return node.clone_with(scope[node.name])
+            self.free.add(node.name)
+            return node
+        elif isinstance(node, List):
+            return node.clone_with(self.visit(value, write, loop)
+                                   for value in node.values)
+        elif isinstance(node, Tuple):
+            return self._visit_tuple(node, write, loop)
+        return node
+
+    def _visit_tuple(self, node, write, loop):
+        sym, norm_args = _norm_args(node)
+        type_ = sym.__type__
+        stmt = write and returns_markup(node)
+        replacements = {}
+
+        if type_ is HTML_TAG_TYPE:
+            attrs, body = norm_args
+            for value in attrs.values():
+                replacements[id(value)] = self.visit(value, False, loop)
+            for value in body:
+                replacements[id(value)] = self.visit(value, True, loop)
+
+        elif type_ is JOIN1_TYPE:
+            col, = norm_args
+            replacements[id(col)] = self.visit(col, True, loop)
+
+        elif type_ in _IF_TYPES:
+            test, branches = norm_args[0], norm_args[1:]
+            replacements[id(test)] = self.visit(test, False, loop)
+            for branch in branches:
+                replacements[id(branch)] = self.visit(branch, stmt, loop)
+
+        elif type_ is LET_TYPE:
+            bindings, expr = norm_args
+            names, values = bindings.values[::2], bindings.values[1::2]
+            values = [self.visit(value, False, loop) for value in values]
+            with self._scope(names) as scope:
+                replacements[id(expr)] = self.visit(expr, stmt, loop)
+            new_bindings = []
+            for name, value in zip(names, values):
+                new_bindings.extend([name.clone_with(scope[name.name]), value])
+            replacements[id(bindings)] = bindings.clone_with(new_bindings)
+
+        elif type_ in (IF_SOME1_TYPE, IF_SOME2_TYPE, IF_SOME3_TYPE):
+            bind, branches = norm_args[0], norm_args[1:]
+            name, value = bind.values
+            value = self.visit(value, False, loop)
+            with self._scope([name]) as scope:
+                for branch in branches:
+                    replacements[id(branch)] = self.visit(branch, stmt, loop)
+            replacements[id(bind)] = bind.clone_with(
+                [name.clone_with(scope[name.name]), value])
+
+        elif type_ is EACH_TYPE:
+            var, col, body = norm_args
+            replacements[id(col)] = self.visit(col, False, loop)
+            with self._scope([var]) as scope:
+                replacements[id(body)] = self.visit(body, True, True)
+            replacements[id(var)] = var.clone_with(scope[var.name])
+
+        elif type_ is GET_TYPE:
+            obj, _ = norm_args
+            replacements[id(obj)] = self.visit(obj, False, loop)
+
+        else:
+            # markup arguments of the kinko functions are written into the
+            # buffer, arguments of the builtin functions are expressions
+            for value in node.values[1:]:
+                if not isinstance(value, Keyword):
+                    replacements[id(value)] = self.visit(value, bool(sym.ns),
+                                                         loop)
+
+        return _replace(node, replacements)
+
+
+class _Inliner(object):
+    """Inlines calls of the small functions, defined in the same module
+
+    Function body is inlined only when it is smaller than `threshold` nodes
+    and when every markup argument can be written directly, without
+    rendering it into the separate buffer. Other arguments are bound to
+    the local variables using `let` form.
+    """
+
+    def __init__(self, body, threshold=INLINE_THRESHOLD, exclude=()):
+        self.defs = {name: def_body for name, def_body
+                     in filter(None, map(_def_body, body.values))
+                     if name not in exclude}
+        self.threshold = threshold
+        self._counter = count(1)
+        self._stack = []
+        self._bound = []
+
+    @contextmanager
+    def _bind(self, names):
+        self._bound.extend(sym.name for sym in names)
+        try:
+            yield
+        finally:
+            del self._bound[len(self._bound) - len(names):]
+
+    def visit(self, node):
+        if isinstance(node, List):
+            return node.clone_with(self.visit(value) for value in node.values)
+        elif not isinstance(node, Tuple):
+            return node
+
+        sym, norm_args = _norm_args(node)
+        type_ = sym.__type__
+        replacements = {}
+
+        if type_ is LET_TYPE:
+            bindings, expr = norm_args
+            replacements[id(bindings)] = self.visit(bindings)
+            with self._bind(bindings.values[::2]):
+                replacements[id(expr)] = self.visit(expr)
+
+        elif type_ in (IF_SOME1_TYPE, IF_SOME2_TYPE, IF_SOME3_TYPE):
+            bind, branches = norm_args[0], norm_args[1:]
+            replacements[id(bind)] = self.visit(bind)
+            with self._bind(bind.values[:1]):
+                for branch in branches:
+                    replacements[id(branch)] = self.visit(branch)
+
+        elif type_ is EACH_TYPE:
+            var, col, body = norm_args
+            replacements[id(col)] = self.visit(col)
+            with self._bind([var]):
+                replacements[id(body)] = self.visit(body)
+
+        else:
+            for value in node.values[1:]:
+                if not isinstance(value, Keyword):
+                    replacements[id(value)] = self.visit(value)
+
+        node = _replace(node, replacements)
+        if sym.ns == '.' and sym.rel in self.defs:
+            inlined = self._inline(node)
+            if inlined is not None:
+                return inlined
+        return node
+
+    def _inline(self, node):
+        sym, norm_args = _norm_args(node)
+        body = self.defs[sym.rel]
+        if sym.rel in self._stack:
+            return None
+        if not all(isinstance(arg_type, NamedArgMeta)
+                   for arg_type in sym.__type__.__args__):
+            return None
+        counter = _NodesCounter()
+        counter.visit(body)
+        if counter.count > self.threshold:
+            return None
+
+        params, markup, bindings = {}, {}, []
+        for arg_type, value in zip(sym.__type__.__args__, norm_args):
+            name = arg_type.__arg_name__
+            if isinstance(value, Tuple) and returns_markup(value):
+                markup[name] = value
+            else:
+                params[name] = Symbol('{}__{}'.format(name,
+                                                      next(self._counter)),
+                                      type=value.__type__)
+                bindings.extend([params[name], value])
+
+        substitution = _Substitution(params, markup, self._counter)
+        inlined = substitution.visit(body, True)
+        if substitution.failed or substitution.free.intersection(self._bound):
+            return None
+
+        if bindings:
+            inlined = Tuple([Symbol('let', type=LET_TYPE), List(bindings),
+                             inlined], location=node.location,
+                            type=node.__type__)
+        self._stack.append(sym.rel)
+        try:
+            return self.visit(inlined)
+        finally:
+            self._stack.pop()
+
+
 def _let_expr(env, bindings, expr_compiler):
     names, values = bindings.values[::2], bindings.values[1::2]
     value_exprs = [compile_expr(env, value) for value in values]
@@ -292,6 +1134,8 @@ def compile_expr(env, node):
             return _result_get(node.name)
 
     elif isinstance(node, Placeholder):
+        if env.thunks and returns_markup(node):
+            return _render_markup(py.Name(env[node.name], py.Load()))
         return py.Name(env[node.name], py.Load())
 
     elif isinstance(node, String):
@@ -310,13 +1154,26 @@ def compile_expr(env, node):
 
 def compile_def_stmt(env, node, name_sym, body):
     arg_names = [a.__arg_name__ for a in get_type(node).__args__]
+    fragment = env.fragments.get(name_sym.name)
+    fn_name = name_sym.name
+    if fragment is not None:
+        fn_name = '{}{}'.format(name_sym.name, FRAGMENT_SUFFIX)
     with env.push(['ctx']):
-        py_args = [py.arg('ctx')]
         with env.push(arg_names):
-            py_args.extend(py.arg(env[arg]) for arg in arg_names)
-            yield py.FunctionDef(name_sym.name,
-                                 py.arguments(py_args, None, None, []),
+            py_arg_names = ['ctx'] + [env[arg] for arg in arg_names]
+            yield py.FunctionDef(fn_name,
+                                 py.arguments(list(map(py.arg, py_arg_names)),
+                                              None, None, []),
                                  list(compile_stmt(env, body)), [])
+            if fragment is not None:
+                # renders function using fragments cache of the lookup
+                yield py.FunctionDef(
+                    name_sym.name,
+                    py.arguments(list(map(py.arg, py_arg_names)),
+                                 None, None, []),
+                    [_render_fragment(fragment, fn_name, py_arg_names[1:])],
+                    [],
+                )
 
 
 def compile_let_stmt(env, node, bindings, expr):
@@ -416,18 +1273,31 @@ STMT_TYPES = {
 }
 
 
+def _thunk(env, names, value):
+    """Returns definition of the function, which writes markup argument into
+    the buffer, and expression to pass this function as an argument
+    """
+    if isinstance(value, Placeholder):
+        return [], py.Name(env[value.name], py.Load())
+    name = env[next(names)]
+    func = py.FunctionDef(name, py.arguments([], None, None, []),
+                          list(_yield_writes(env, value)), [])
+    return [func], py.Name(name, py.Load())
+
+
 def compile_func_stmt(env, node, *norm_args):
     sym = node.values[0]
 
-    pos_args, kw_args = [], {}
+    # named arguments are passed in the order of declaration
+    pos_args, kw_args = [], OrderedDict()
     for arg_type, arg_value in zip(sym.__type__.__args__, norm_args):
         if isinstance(arg_type, NamedArgMeta):
             kw_args[arg_type.__arg_name__] = (arg_type.__arg_type__, arg_value)
         elif isinstance(arg_type, VarArgsMeta):
             pos_args.extend((arg_type.__arg_type__, v) for v in arg_value)
         elif isinstance(arg_type, VarNamedArgsMeta):
-            kw_args.update({key: (arg_type.__arg_type__, value)
-                            for key, value in arg_value.items()})
+            for key, value in arg_value.items():
+                kw_args[key] = (arg_type.__arg_type__, value)
         else:
             pos_args.append((arg_type, arg_value))
 
@@ -435,46 +1305,65 @@ def compile_func_stmt(env, node, *norm_args):
         if sym.ns == '.':
             name_expr = py.Name(sym.rel, py.Load())
         else:
-            name_expr = py.Call(py.Attribute(py.Name('ctx', py.Load()),
-                                             'lookup', py.Load()),
-                                [py.Str(sym.name)], [], None, None)
+            name_expr = py.Name(link_name(sym.name), py.Load())
     else:
         builtins = py.Attribute(py.Name('ctx', py.Load()), 'builtins',
                                 py.Load())
         name_expr = py.Subscript(builtins, py.Index(py.Str(sym.name)),
                                  py.Load())
 
-    kw_arg_exprs = []
-    for key, (type_, value) in kw_args.items():
-        if returns_markup(value):
-            yield _buf_push()
-            for item in _yield_writes(env, value):
-                yield item
-            kw_arg_exprs.append(py.keyword(key, _buf_pop()))
-        else:
-            kw_arg_exprs.append(py.keyword(key, compile_expr(env, value)))
-
-    pos_arg_exprs = []
-    # capturing args in reversed order to preserve proper ordering
-    # during second reverse
-    for type_, value in reversed(pos_args):
-        if returns_markup(value):
-            yield _buf_push()
-            for item in _yield_writes(env, value):
-                yield item
-            pos_arg_exprs.append(_buf_pop())
-        else:
-            pos_arg_exprs.append(compile_expr(env, value))
+    # markup arguments of the kinko functions are passed as thunks, when
+    # enabled, so they are written directly into the current buffer
+    thunks = env.thunks and sym.ns
+    thunk_names = ['_thunk{}'.format(i)
+                   for i in range(len(pos_args) + len(kw_args))]
+    names = iter(thunk_names)
+
+    with env.push(thunk_names if thunks else []):
+        kw_arg_exprs = []
+        # capturing args in reversed order, so they are applied in the order
+        # of declaration
+        for key, (type_, value) in reversed(list(kw_args.items())):
+            if returns_markup(value) and thunks:
+                stmts, thunk = _thunk(env, names, value)
+                for item in stmts:
+                    yield item
+                kw_arg_exprs.append(py.keyword(key, thunk))
+            elif returns_markup(value):
+                yield _buf_push()
+                for item in _yield_writes(env, value):
+                    yield item
+                kw_arg_exprs.append(py.keyword(key, _buf_pop()))
+            else:
+                kw_arg_exprs.append(py.keyword(key,
+                                               compile_expr(env, value)))
+
+        pos_arg_exprs = []
+        # capturing args in reversed order to preserve proper ordering
+        # during second reverse
+        for type_, value in reversed(pos_args):
+            if returns_markup(value) and thunks:
+                stmts, thunk = _thunk(env, names, value)
+                for item in stmts:
+                    yield item
+                pos_arg_exprs.append(thunk)
+            elif returns_markup(value):
+                yield _buf_push()
+                for item in _yield_writes(env, value):
+                    yield item
+                pos_arg_exprs.append(_buf_pop())
+            else:
+                pos_arg_exprs.append(compile_expr(env, value))
 
-    pos_arg_exprs.extend([py.Name('ctx', py.Load())])
+        pos_arg_exprs.extend([py.Name('ctx', py.Load())])
 
-    # applying args in reversed order to preserve pushes/pops
-    # consistency
-    py_call = py.Call(name_expr,
-                      pos_arg_exprs[::-1],
-                      kw_arg_exprs[::-1],
-                      None, None)
-    yield (py.Expr(py_call) if sym.ns else py_call)
+        # applying args in reversed order to preserve pushes/pops
+        # consistency
+        py_call = py.Call(name_expr,
+                          pos_arg_exprs[::-1],
+                          kw_arg_exprs[::-1],
+                          None, None)
+        yield (py.Expr(py_call) if sym.ns else py_call)
 
 
 def compile_stmt(env, node):
@@ -496,7 +1385,10 @@ def compile_stmt(env, node):
             yield _write(_result_get(node.name), node)
 
     elif isinstance(node, Placeholder):
-        yield _write(py.Name(env[node.name], py.Load()), node)
+        if env.thunks and returns_markup(node):
+            yield _write_markup(py.Name(env[node.name], py.Load()))
+        else:
+            yield _write(py.Name(env[node.name], py.Load()), node)
 
     elif isinstance(node, String):
         yield _write(py.Str(node.value))
@@ -509,17 +1401,55 @@ def compile_stmt(env, node):
                         .format(node, type(node)))
 
 
+class _Environ(Environ):
+
+    def __init__(self, thunks=False, fragments=None):
+        super(_Environ, self).__init__()
+        self.thunks = thunks
+        self.fragments = fragments or {}
+
+
 def compile_stmts(env, nodes):
     for node in nodes:
         for item in compile_stmt(env, node):
             yield item
 
 
-def compile_module(body):
+def compile_module(body, flush=False, hoist=False, fold=False,
+                   inline=False, thunks=False, format_writes=False,
+                   fragments=None):
+    """Compiles module definitions into Python AST
+
+    When `flush` is True, compiled code will call `ctx.buffer.flush()` in the
+    points, where rendered content can be streamed. When `hoist` is True,
+    context attributes, buffer methods and builtins are bound to the local
+    variables in every function. When `fold` is True, constant expressions
+    and static markup are evaluated and rendered during compilation. When
+    `inline` is True, calls of the small functions, defined in the same
+    module, are replaced with their bodies. When `thunks` is True, markup
+    arguments are passed to the functions as closures, which write them
+    directly into the current buffer. When `format_writes` is True,
+    sequences of writes are replaced with the single write of the formatted
+    string. `fragments` maps names of the functions, which content should be
+    cached, to their full names; these functions are rendered using
+    `ctx.fragment` and are never inlined.
+    """
     assert isinstance(body, List), repr(body)
-    env = Environ()
+    fragments = fragments or {}
+    if inline:
+        body = _Inliner(body, exclude=fragments).visit(body)
+    if fold:
+        folder = _ConstantFolder()
+        body = body.clone_with(folder.fold(node, True) for node in body.values)
+    env = _Environ(thunks, fragments)
     mod = py.Module(list(compile_stmts(env, body.values)))
-    mod = _Optimizer().visit(mod)
+    mod = _Optimizer(merge_branches=fold).visit(mod)
+    if format_writes:
+        mod = _FormattedWrites().visit(mod)
+    if flush:
+        mod = _FlushPoints().visit(mod)
+    if hoist:
+        mod = _LocalsHoister().visit(mod)
     fix_missing_locations(mod)
     return mod
 
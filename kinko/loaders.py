@@ -1,6 +1,24 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
 import errno
 import codecs
+import logging
+import pickle
+import select
+import struct
+import marshal
 import os.path
+import tempfile
+import threading
+import ctypes.util
+from types import CodeType
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
 
 
 class NamespaceNotFound(LookupError):
@@ -17,13 +35,26 @@ class Source(object):
 
 
 class LoaderBase(object):
+    #: True when loaded sources are never modified
+    immutable = False
 
     def is_uptodate(self, ns):
         raise NotImplementedError
 
+    def outdated(self, namespaces):
+        """Returns names of the outdated namespaces
+
+        Loaders may override this method to avoid per-namespace checks.
+        """
+        return {ns.name for ns in namespaces if not self.is_uptodate(ns)}
+
     def load(self, name):
         raise NotImplementedError
 
+    def list(self):
+        """Returns names of all available namespaces"""
+        raise NotImplementedError
+
 
 class CacheBase(object):
 
@@ -49,20 +80,47 @@ class DictLoader(LoaderBase):
         except KeyError:
             raise NamespaceNotFound(name)
 
+    def list(self):
+        return sorted(self._sources)
+
 
 class FileSystemLoader(LoaderBase):
+    """Loads sources from the directory
+
+    By default every namespace is checked for modifications every time it
+    is used. When `check_interval` (in seconds) is specified, every namespace
+    is checked at most once per this interval. In `immutable` mode sources
+    are never checked for modifications after they were loaded.
+    """
     _encoding = 'utf-8'
     _template = '{}.kinko'
 
-    def __init__(self, path):
+    def __init__(self, path, check_interval=None, immutable=False):
         self._path = path
+        self._check_interval = check_interval
+        self.immutable = immutable
+        self._checked = {}
 
     def is_uptodate(self, ns):
+        if self.immutable:
+            return True
+        if self._check_interval is not None:
+            now = time.time()
+            if now - self._checked.get(ns.name, 0) < self._check_interval:
+                return True
         file_name = os.path.join(self._path, self._template.format(ns.name))
         try:
-            return os.path.getmtime(file_name) == ns.modified_time
+            uptodate = os.path.getmtime(file_name) == ns.modified_time
         except OSError:
             return False
+        if uptodate and self._check_interval is not None:
+            self._checked[ns.name] = now
+        return uptodate
+
+    def outdated(self, namespaces):
+        if self.immutable:
+            return set()
+        return super(FileSystemLoader, self).outdated(namespaces)
 
     def load(self, name):
         file_path = os.path.join(self._path, self._template.format(name))
@@ -74,8 +132,185 @@ class FileSystemLoader(LoaderBase):
                 raise
             raise NamespaceNotFound(name)
         modified_time = os.path.getmtime(file_path)
+        self._checked[name] = time.time()
         return Source(name, content, modified_time, file_path)
 
+    def list(self):
+        prefix, _, suffix = self._template.partition('{}')
+        return sorted(
+            file_name[len(prefix):len(file_name) - len(suffix)]
+            for file_name in os.listdir(self._path)
+            if file_name.startswith(prefix) and file_name.endswith(suffix) and
+            os.path.isfile(os.path.join(self._path, file_name))
+        )
+
+
+class _Inotify(object):
+    """Minimal ctypes-based binding to the Linux inotify API
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+
+    _mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+             IN_CREATE | IN_DELETE)
+    _event = struct.Struct('iIII')
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    @classmethod
+    def watch(cls, path):
+        """Returns inotify instance or None, if inotify is not available
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return None
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+        fd = libc.inotify_init1(cls.IN_NONBLOCK)
+        if fd < 0:
+            return None
+        path_bytes = path.encode(sys.getfilesystemencoding()) \
+            if not isinstance(path, bytes) else path
+        if libc.inotify_add_watch(fd, path_bytes, cls._mask) < 0:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def read(self, timeout):
+        """Waits for events and returns names of the changed files
+
+        Returns None if events queue was overflowed and every file should be
+        considered as changed.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            names.add(name.decode(sys.getfilesystemencoding()))
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WatchingFileSystemLoader(FileSystemLoader):
+    """Loads sources from the directory and watches them for modifications
+
+    Modifications are tracked in the background thread using inotify, when
+    it is available, or by polling modification time of the loaded sources
+    every `poll_interval` seconds. Changed namespaces are marked as dirty,
+    so up-to-date checks are just lookups in the in-memory set.
+
+    Namespaces are loaded only from the top-level directory, so only this
+    directory is watched. If watching fails, error is logged, every loaded
+    namespace is marked as dirty and loader falls back to polling.
+    """
+
+    def __init__(self, path, poll_interval=1.0, use_inotify=True):
+        super(WatchingFileSystemLoader, self).__init__(path)
+        self._poll_interval = poll_interval
+        self._modified_times = {}
+        self._dirty = set()
+        self._stopped = threading.Event()
+        self._inotify = _Inotify.watch(path) if use_inotify else None
+        self._thread = threading.Thread(target=self._watch,
+                                        name='kinko-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _changed_names(self):
+        if self._inotify is not None:
+            file_names = self._inotify.read(self._poll_interval)
+            if file_names is None:
+                return set(self._modified_times)
+            suffix = self._template.format('')
+            return {file_name[:-len(suffix)] for file_name in file_names
+                    if file_name.endswith(suffix)}
+        else:
+            self._stopped.wait(self._poll_interval)
+            return self._poll()
+
+    def _poll(self):
+        changed = set()
+        for name, modified_time in list(self._modified_times.items()):
+            file_path = os.path.join(self._path, self._template.format(name))
+            try:
+                if os.path.getmtime(file_path) != modified_time:
+                    changed.add(name)
+            except OSError:
+                changed.add(name)
+        return changed
+
+    def _fail(self):
+        log.exception('Failed to watch %s for modifications', self._path)
+        if self._inotify is not None:
+            inotify, self._inotify = self._inotify, None
+            try:
+                inotify.close()
+            except OSError:
+                pass
+        else:
+            # prevents busy loop, when polling fails permanently
+            self._stopped.wait(self._poll_interval)
+        # modifications could be missed
+        return set(self._modified_times)
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            try:
+                changed = self._changed_names()
+            except Exception:
+                changed = self._fail()
+            changed.intersection_update(self._modified_times)
+            # set operations are atomic, so dirty set is updated without
+            # additional locking
+            self._dirty.update(changed)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def is_uptodate(self, ns):
+        return ns.name not in self._dirty
+
+    def outdated(self, namespaces):
+        if not self._dirty:
+            return set()
+        return super(WatchingFileSystemLoader, self).outdated(namespaces)
+
+    def load(self, name):
+        # marking as clean before reading to not miss concurrent changes
+        self._dirty.discard(name)
+        source = super(WatchingFileSystemLoader, self).load(name)
+        self._modified_times[name] = source.modified_time
+        return source
+
 
 class DictCache(CacheBase):
 
@@ -90,3 +325,111 @@ class DictCache(CacheBase):
 
     def set(self, name, code):
         self._cache[name] = code
+
+
+class LRUCache(CacheBase):
+    """In-memory cache, which holds at most `maxsize` recently used values
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            try:
+                value = self._cache.pop(name)
+            except KeyError:
+                raise NamespaceNotFound(name)
+            self._cache[name] = value
+            return value
+
+    def set(self, name, code):
+        with self._lock:
+            self._cache.pop(name, None)
+            self._cache[name] = code
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+
+class TieredCache(CacheBase):
+    """Two-level cache: fast process-local cache in front of the shared one
+
+    Values found in the shared cache are copied into the local cache, new
+    values are stored in both of them.
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, name):
+        try:
+            return self.local.get(name)
+        except NamespaceNotFound:
+            code = self.shared.get(name)
+            self.local.set(name, code)
+            return code
+
+    def set(self, name, code):
+        self.local.set(name, code)
+        self.shared.set(name, code)
+
+
+class _Pickler(pickle.Pickler):
+    # code objects are not picklable, so they are stored as marshalled
+    # persistent references
+
+    def persistent_id(self, obj):
+        if isinstance(obj, CodeType):
+            return marshal.dumps(obj)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        return marshal.loads(pid)
+
+
+class FileSystemCache(CacheBase):
+    """Stores cached values as files in the specified directory
+
+    Values may contain compiled code objects. Files are written atomically,
+    so this cache can be shared by several processes.
+    """
+    _template = '{}.kinkoc'
+
+    def __init__(self, path):
+        self._path = path
+
+    def get(self, name):
+        file_path = os.path.join(self._path, self._template.format(name))
+        try:
+            with open(file_path, 'rb') as f:
+                return _Unpickler(f).load()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise NamespaceNotFound(name)
+        except (EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            # broken or incompatible file, will be overwritten
+            raise NamespaceNotFound(name)
+
+    def set(self, name, code):
+        if not os.path.isdir(self._path):
+            try:
+                os.makedirs(self._path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        file_path = os.path.join(self._path, self._template.format(name))
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _Pickler(f, 2).dump(code)
+            os.rename(tmp_path, file_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
@@ -1,17 +1,29 @@
+from __future__ import absolute_import
+
+import gc
 import logging
-from collections import namedtuple
+import hashlib
+import threading
+from types import FunctionType, CodeType
+from collections import namedtuple, OrderedDict
+
+from markupsafe import Markup
 
-from .refs import extract
+from .refs import RefsCollector, queries
+from .query import Link
 from .nodes import NodeVisitor
-from .utils import Buffer
+from .types import TypeVisitor
+from .utils import Buffer, StreamingBuffer
 from .parser import parse
 from .errors import UserError, WARNING, ERROR, Errors
-from .compat import _exec_in
+from .compat import text_type, integer_types, MAGIC_NUMBER, queue
+from .read.result import Ref
 from .checker import def_types, split_defs, Environ, check, collect_defs
 from .checker import NamesResolver, NamesUnResolver
-from .loaders import DictCache
+from .modules import module_name, import_code, evict
+from .loaders import LRUCache, TieredCache, NamespaceNotFound
 from .tokenizer import tokenize
-from .compile.python import compile_module
+from .compile.python import compile_module, unlink_name, LINK_PREFIX
 
 
 log = logging.getLogger(__name__)
@@ -35,54 +47,431 @@ class DependenciesVisitor(NodeVisitor):
         super(DependenciesVisitor, self).visit_tuple(node)
 
 
+class _TypesDigest(TypeVisitor):
+    """Builds stable string representation of the type
+
+    Unlike `repr`, it doesn't depend on identity of the type variables and on
+    ordering of the records items and union types.
+    """
+
+    def visit_bool(self, type_):
+        return 'bool'
+
+    def visit_nothing(self, type_):
+        return 'none'
+
+    def visit_string(self, type_):
+        return 'str'
+
+    def visit_int(self, type_):
+        return 'int'
+
+    def visit_markup(self, type_):
+        return 'markup'
+
+    def visit_typevar(self, type_):
+        if type_.__instance__ is not None:
+            return self.visit(type_.__instance__)
+        return '?'
+
+    def visit_typeref(self, type_):
+        return '<{}>'.format(type_.__ref_name__)
+
+    def visit_union(self, type_):
+        return '|'.join(sorted(self.visit(t) for t in type_.__types__))
+
+    def visit_option(self, type_):
+        return 'Option[{}]'.format(self.visit_union(type_))
+
+    def visit_func(self, type_):
+        return '({} -> {})'.format(' '.join(self.visit(t)
+                                            for t in type_.__args__),
+                                   self.visit(type_.__result__))
+
+    def visit_varargs(self, type_):
+        return '*{}'.format(self.visit(type_.__arg_type__))
+
+    def visit_namedarg(self, type_):
+        return ':{} {}'.format(type_.__arg_name__,
+                               self.visit(type_.__arg_type__))
+
+    def visit_varnamedargs(self, type_):
+        return '**{}'.format(self.visit(type_.__arg_type__))
+
+    def visit_list(self, type_):
+        return '[{}]'.format(self.visit(type_.__item_type__))
+
+    def visit_dict(self, type_):
+        return '{{:{} {}}}'.format(self.visit(type_.__key_type__),
+                                   self.visit(type_.__value_type__))
+
+    def visit_record(self, type_):
+        return '{{{}}}'.format(' '.join(
+            ':{} {}'.format(key, self.visit(value))
+            for key, value in sorted(type_.__items__.items())
+        ))
+
+
+def _digest(*parts):
+    hash_ = hashlib.sha1()
+    for part in parts:
+        hash_.update(text_type(part).encode('utf-8'))
+        hash_.update(b'\0')
+    return hash_.hexdigest()
+
+
+def types_digest(types):
+    visitor = _TypesDigest()
+    return _digest(*('{} {}'.format(name, visitor.visit(type_))
+                     for name, type_ in sorted(types.items())))
+
+
+# bump this version every time when compiled code or queries format changes
+CACHE_VERSION = 14
+
+# options of the Python compiler, used to compile namespaces
+COMPILE_OPTIONS = dict(hoist=True, fold=True, inline=True, thunks=True,
+                       format_writes=True)
+
+# `types` and `refs` contain inferred types and collected references of the
+# namespace definitions, they are used to check and compile dependent
+# namespaces incrementally and are not available when namespace is loaded
+# from cache
 Namespace = namedtuple('Namespace',
-                       'name modified_time module dependencies')
+                       'name modified_time digest module dependencies '
+                       'types refs')
 
 ParsedSource = namedtuple('ParsedSource',
-                          'name modified_time node dependencies')
+                          'name modified_time digest node dependencies')
+
+CheckedSource = namedtuple('CheckedSource',
+                           'name modified_time digest node dependencies '
+                           'types refs')
+
+# compiled namespace, stored in cache; `sources` contains digests of all
+# namespaces in the dependencies closure, this namespace was compiled with
+Compiled = namedtuple('Compiled', 'name code reqs dependencies sources')
+
+# process-wide registry of the compiled namespaces, used by lookups created
+# with `shared=True`; cache keys include digests of the sources and types,
+# so lookups over the same sources are sharing compiled code and queries
+# through it
+REGISTRY = LRUCache(maxsize=1024)
+
+
+def _update(hash_, tag, data):
+    hash_.update(tag)
+    hash_.update(str(len(data)).encode('ascii'))
+    hash_.update(b':')
+    hash_.update(data)
+
+
+def _sort_key(item):
+    key = item[0]
+    if isinstance(key, text_type):
+        return 0, key
+    hash_ = hashlib.sha1()
+    _fingerprint(hash_, key)
+    return 1, hash_.digest()
+
+
+def _fingerprint(hash_, value):
+    """Updates hash with the JSON-like value, which doesn't depend on dict
+    ordering, raises TypeError for values of other types
+
+    References are identified by their entity and identifier, referenced
+    values are part of the result.
+    """
+    if value is None:
+        hash_.update(b'n')
+    elif value is True or value is False:
+        hash_.update(b't' if value else b'f')
+    elif isinstance(value, integer_types):
+        _update(hash_, b'i', str(value).encode('ascii'))
+    elif isinstance(value, float):
+        _update(hash_, b'd', repr(value).encode('ascii'))
+    elif isinstance(value, Markup):
+        _update(hash_, b'm', value.encode('utf-8'))
+    elif isinstance(value, text_type):
+        _update(hash_, b's', value.encode('utf-8'))
+    elif isinstance(value, bytes):
+        _update(hash_, b'b', value)
+    elif isinstance(value, dict):
+        hash_.update(b'{')
+        for key, item in sorted(value.items(), key=_sort_key):
+            _fingerprint(hash_, key)
+            _fingerprint(hash_, item)
+        hash_.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        hash_.update(b'[')
+        for item in value:
+            _fingerprint(hash_, item)
+        hash_.update(b']')
+    elif isinstance(value, Ref):
+        hash_.update(b'r')
+        _fingerprint(hash_, value.entity)
+        _fingerprint(hash_, value.ident)
+    else:
+        raise TypeError("Can't fingerprint value of type {}"
+                        .format(type(value).__name__))
+
+
+class RenderCache(object):
+    """In-memory cache of the rendered content, which holds recently used
+    content of at most `maxsize` characters in total
+    """
+
+    def __init__(self, maxsize=64 * 1024 * 1024):
+        self.maxsize = maxsize
+        self._size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            content = self._cache.pop(key, None)
+            if content is not None:
+                self._cache[key] = content
+            return content
+
+    def set(self, key, content):
+        if len(content) > self.maxsize:
+            return
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._cache[key] = content
+            self._size += len(content)
+            while self._size > self.maxsize:
+                _, old = self._cache.popitem(last=False)
+                self._size -= len(old)
+
+
+class FragmentCache(RenderCache):
+    """Holds names of the functions, which rendered content should be cached,
+    and their recently rendered content
+
+    Content is cached by the values of the arguments and of the result
+    fields, which function reads. Builtins are not part of the key, so
+    cached functions should use only builtins, which return the same values
+    for the same arguments. `hits` and `misses` count cache lookups.
+    """
+
+    def __init__(self, names, maxsize=16 * 1024 * 1024):
+        super(FragmentCache, self).__init__(maxsize)
+        self.names = frozenset(names)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        content = super(FragmentCache, self).get(key)
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return content
+
+
+def _project(edge, value):
+    """Returns part of the value, requested by the query"""
+    if isinstance(value, (list, tuple)):
+        return [_project(edge, item) for item in value]
+    elif value is None or not edge.fields:
+        return value
+    projected = {}
+    for name, field in edge.fields.items():
+        try:
+            item = value[name]
+        except KeyError:
+            continue
+        if isinstance(field, Link):
+            item = _project(field.edge, item)
+        projected[name] = item
+    return projected
+
+
+def _code_names(code):
+    for name in code.co_names:
+        yield name
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            for name in _code_names(const):
+                yield name
+
+
+def _links(module):
+    """Returns names of the global variables, which should be linked"""
+    links = set([])
+    for value in module.values():
+        if isinstance(value, FunctionType) and value.__globals__ is module:
+            links.update(name for name in _code_names(value.__code__)
+                         if name.startswith(LINK_PREFIX))
+    return links
 
 
 class SimpleContext(object):
 
-    def __init__(self, result):
-        self.buffer = Buffer()
+    def __init__(self, result, buffer=None):
+        self.buffer = Buffer() if buffer is None else buffer
         self.result = result
 
 
+class _Cancelled(Exception):
+    pass
+
+
 class Function(object):
 
     def __init__(self, lookup, name):
         self._lookup = lookup
         self.name = name
+        self._ns_name = name.partition('/')[0]
+        self._query = None, None
 
     def query(self):
-        return self._lookup._get_query(self.name)
-
-    def render(self, result):
-        return self._lookup._render(self.name, result)
+        """Returns query of the function
+
+        Query is cached until namespace of the function is reloaded. When
+        sources can't change, they aren't checked for modifications.
+        """
+        lookup = self._lookup
+        if not lookup._immutable:
+            lookup._load(self._ns_name)
+        ns, query = self._query
+        if ns is None or lookup._namespaces.get(self._ns_name) is not ns:
+            query = lookup._get_query(self.name)
+            self._query = lookup._namespaces[self._ns_name], query
+        return query
+
+    def fingerprint(self, result):
+        """Returns digest of the function's code and the result, which
+        identifies rendered content
+
+        Raises TypeError when result contains values, which are not
+        JSON-like. Digest can be passed to the `render` and `render_to`
+        methods to not compute it again.
+        """
+        return self._lookup._render_key(self.name, result)
+
+    def render(self, result, fingerprint=None):
+        return self._lookup._render(self.name, result, fingerprint)
+
+    def render_to(self, result, sink, chunk_size=4096, fingerprint=None):
+        """Renders content and sends it to the `sink` callable in chunks"""
+        self._lookup._render_to(self.name, result, sink, chunk_size,
+                                fingerprint)
+
+    def render_iter(self, result, chunk_size=4096):
+        """Returns iterator over rendered content chunks
+
+        Content is rendered in a separate thread, so first chunks are
+        available before whole content is rendered. Rendering is cancelled
+        when iterator is closed before it is exhausted.
+        """
+        chunks = queue.Queue(maxsize=16)
+        stop = threading.Event()
+        done = object()
+        error = []
+
+        def sink(chunk):
+            if stop.is_set():
+                raise _Cancelled()
+            chunks.put(chunk)
+
+        def render():
+            try:
+                self.render_to(result, sink, chunk_size)
+            except _Cancelled:
+                pass
+            except Exception as e:
+                error.append(e)
+            finally:
+                chunks.put(done)
+
+        thread = threading.Thread(target=render)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            if thread.is_alive():
+                stop.set()
+                # unblock rendering thread, which waits for a free slot
+                while True:
+                    try:
+                        chunks.get_nowait()
+                    except queue.Empty:
+                        break
+        thread.join()
+        if error:
+            raise error[0]
 
 
 class Context(SimpleContext):
 
-    def __init__(self, lookup, result):
+    def __init__(self, lookup, result, buffer=None):
         self._lookup = lookup
-        super(Context, self).__init__(result)
+        super(Context, self).__init__(result, buffer)
         self.builtins = lookup.builtins
 
     def lookup(self, name):
         ns, _, fn_name = name.partition('/')
         return self._lookup._get_namespace(ns).module[fn_name]
 
+    def fragment(self, name, fn, args):
+        """Renders cacheable function, called by the compiled code"""
+        if any(callable(arg) for arg in args):
+            # markup arguments, passed as closures, can't be cached
+            fn(self, *args)
+            return
+        cache = self._lookup.fragments
+        try:
+            key = self._lookup._fragment_key(name, fn, args, self.result)
+        except TypeError:
+            # values, which can't be fingerprinted, aren't cached
+            fn(self, *args)
+            return
+        content = cache.get(key)
+        if content is None:
+            self.buffer.push()
+            fn(self, *args)
+            content = self.buffer.pop()
+            cache.set(key, content)
+        self.buffer.write(content)
+
 
 class Lookup(object):
 
-    def __init__(self, types, loader, cache=None, builtins=None):
+    def __init__(self, types, loader, cache=None, builtins=None,
+                 buffer_cls=Buffer, shared=False, render_cache=None,
+                 fragments=None):
         self.types = types
         self._loader = loader
-        self._cache = cache or DictCache()
+        self._immutable = loader is None or loader.immutable
+        self.render_cache = render_cache
+        self.fragments = fragments
+        if shared:
+            cache = REGISTRY if cache is None else TieredCache(REGISTRY, cache)
+        elif cache is None:
+            cache = LRUCache()
+        self._cache = cache
         self.builtins = builtins or {}
+        self.buffer_cls = buffer_cls
         self._namespaces = {}
+        self._functions = {}
+        # digests of the sources, namespaces were compiled from
+        self._closures = {}
         self._reqs = {}
+        # cacheable functions are compiled differently
+        fragment_names = sorted(fragments.names) if fragments else []
+        self._cache_prefix = _digest(CACHE_VERSION, repr(MAGIC_NUMBER),
+                                     types_digest(types), *fragment_names)
 
     def _get_dependencies(self, ns, _visited=None):
         _visited = set([]) if _visited is None else _visited
@@ -94,9 +483,15 @@ class Lookup(object):
                 for item in self._get_dependencies(dep, _visited=_visited):
                     yield item
 
-    def _load_sources(self, name, _visited=None):
+    def _load_sources(self, name, reused=None, _visited=None):
+        reused = {} if reused is None else reused
         _visited = set([]) if _visited is None else _visited
-        if name not in _visited:
+        if name in reused and name not in _visited:
+            _visited.add(name)
+            for dep in reused[name].dependencies:
+                for item in self._load_sources(dep, reused, _visited):
+                    yield item
+        elif name not in _visited:
             _visited.add(name)
             source = self._loader.load(name)
 
@@ -110,9 +505,10 @@ class Lookup(object):
 
             node = NamesResolver(source.name).visit(node)
             dependencies = DependenciesVisitor.get_dependencies(node)
-            yield ParsedSource(name, source.modified_time, node, dependencies)
+            yield ParsedSource(name, source.modified_time,
+                               _digest(source.content), node, dependencies)
             for dep in dependencies:
-                for item in self._load_sources(dep, _visited=_visited):
+                for item in self._load_sources(dep, reused, _visited):
                     yield item
 
     def _format_error(self, error):
@@ -173,8 +569,11 @@ class Lookup(object):
         if errors_list:
             raise error_cls('\n'.join(errors_list))
 
-    def _check(self, parsed_sources):
+    def _check(self, parsed_sources, reused=None):
+        reused = {} if reused is None else reused
         env = dict(self.types)
+        for ns in reused.values():
+            env.update(ns.types)
 
         node = collect_defs(ps.node for ps in parsed_sources)
         env.update(def_types(node))
@@ -186,41 +585,212 @@ class Lookup(object):
             self._raise_on_errors(environ.errors, type(e))
         else:
             self._raise_on_errors(environ.errors)
-        reqs = extract(node)
+
+        refs = RefsCollector.collect(node)
+        all_refs = {}
+        for ns in reused.values():
+            all_refs.update(ns.refs)
+        all_refs.update(refs)
+        reqs = queries(all_refs, refs)
 
         modules = {ns: NamesUnResolver(ns).visit(mod)
                    for ns, mod in split_defs(node).items()}
 
-        checked_sources = [ps._replace(node=modules[ps.name])
-                           for ps in parsed_sources]
-
+        def ns_items(mapping, ns):
+            return {key: value for key, value in mapping.items()
+                    if key.partition('/')[0] == ns}
+
+        checked_sources = [
+            CheckedSource(ps.name, ps.modified_time, ps.digest,
+                          modules[ps.name], ps.dependencies,
+                          ns_items(environ.defs, ps.name),
+                          ns_items(refs, ps.name))
+            for ps in parsed_sources
+        ]
         return checked_sources, reqs
 
-    def _compile_module(self, name, module):
-        module_code = compile(module, '<{}.kinko>'.format(name), 'exec')
-        globals_dict = {}
-        _exec_in(module_code, globals_dict)
-        return globals_dict
+    def _cache_key(self, name, digest):
+        return _digest(self._cache_prefix, name, digest)
+
+    def _cache_get(self, source):
+        key = self._cache_key(source.name, _digest(source.content))
+        try:
+            return self._cache.get(key)
+        except NamespaceNotFound:
+            return None
+
+    def _namespace(self, compiled, modified_time, types=None, refs=None):
+        key = _digest(self._cache_prefix, compiled.name,
+                      *sorted(compiled.sources.items()))
+        module = self._compile_module(compiled.name, compiled.code, key)
+        return Namespace(compiled.name, modified_time,
+                         compiled.sources[compiled.name], module,
+                         set(compiled.dependencies), types, refs)
+
+    def _load_cached(self, name):
+        source = self._loader.load(name)
+        compiled = self._cache_get(source)
+        if compiled is None:
+            return None
+
+        sources = {name: source}
+        for dep_name, dep_digest in compiled.sources.items():
+            if dep_name in sources:
+                continue
+            try:
+                dep_source = self._loader.load(dep_name)
+            except NamespaceNotFound:
+                return None
+            if _digest(dep_source.content) != dep_digest:
+                return None
+            sources[dep_name] = dep_source
+
+        loaded = [(source, compiled)]
+        for dep_name, dep_source in sources.items():
+            if dep_name != name:
+                dep_compiled = self._cache_get(dep_source)
+                if dep_compiled is None:
+                    return None
+                loaded.append((dep_source, dep_compiled))
+        return [(self._namespace(c, src.modified_time), c)
+                for src, c in loaded]
+
+    def _closure_digests(self, sources, name):
+        by_name = {src.name: src for src in sources}
+        digests = {}
+        queue = [name]
+        while queue:
+            src = by_name[queue.pop()]
+            if src.name not in digests:
+                digests[src.name] = src.digest
+                queue.extend(src.dependencies)
+        return digests
+
+    def _compile(self, name, reused=None):
+        reused = {} if reused is None else reused
+        parsed_sources = list(self._load_sources(name, reused))
+        checked_sources, reqs = self._check(parsed_sources, reused)
+
+        all_sources = list(reused.values()) + checked_sources
+        loaded = []
+        for cs in checked_sources:
+            module = compile_module(cs.node,
+                                    fragments=self._fragments(cs.name),
+                                    **COMPILE_OPTIONS)
+            code = compile(module, '<{}.kinko>'.format(cs.name), 'exec')
+            ns_reqs = {key: value for key, value in reqs.items()
+                       if key.partition('/')[0] == cs.name}
+            compiled = Compiled(cs.name, code, ns_reqs,
+                                sorted(cs.dependencies),
+                                self._closure_digests(all_sources, cs.name))
+            self._cache.set(self._cache_key(cs.name, cs.digest), compiled)
+            namespace = self._namespace(compiled, cs.modified_time,
+                                        cs.types, cs.refs)
+            loaded.append((namespace, compiled))
+        return loaded
+
+    def _fragments(self, ns):
+        if self.fragments is None:
+            return None
+        fragments = {}
+        for name in self.fragments.names:
+            ns_name, _, fn_name = name.partition('/')
+            if ns_name == ns:
+                fragments[fn_name] = name
+        return fragments
+
+    def _compile_module(self, name, code, key):
+        """Returns globals of the module with compiled namespace
+
+        Module is shared with other lookups, which compiled the same
+        namespace with the same dependencies and types.
+        """
+        return vars(import_code(module_name(name, key), code))
+
+    def _link(self, names):
+        """Binds functions from namespaces with specified names into
+        namespaces, which depend on them, and into these namespaces
+        """
+        for ns in list(self._namespaces.values()):
+            if ns.name not in names and not (ns.dependencies & names):
+                continue
+            for link in _links(ns.module):
+                dep_name, _, fn_name = unlink_name(link).partition('/')
+                try:
+                    fn = self._namespaces[dep_name].module[fn_name]
+                except KeyError:
+                    # will raise NameError, when called
+                    ns.module.pop(link, None)
+                else:
+                    ns.module[link] = fn
+
+    def _reusable(self, namespaces, outdated):
+        """Returns namespaces, which can be reused without re-checking
+
+        Namespace can be reused if it was checked by this lookup and it
+        doesn't depend on outdated namespaces.
+        """
+        memo = {}
+
+        def is_reusable(ns):
+            if ns.name not in memo:
+                # pessimistic assumption for the cyclic dependencies
+                memo[ns.name] = False
+                memo[ns.name] = (
+                    ns.types is not None and
+                    ns.name not in outdated and
+                    all(is_reusable(self._namespaces[dep])
+                        for dep in ns.dependencies)
+                )
+            return memo[ns.name]
+
+        return {ns.name: ns for ns in namespaces if is_reusable(ns)}
 
     def _load(self, name):
+        reused = None
         ns = self._namespaces.get(name)
         if ns is not None:
-            deps = list(self._get_dependencies(ns))
-            if all(self._loader.is_uptodate(dep) for dep in deps):
+            outdated = self._loader.outdated(self._get_dependencies(ns))
+            if not outdated:
                 return
-
-        parsed_sources = list(self._load_sources(name))
-        checked_sources, refs = self._check(parsed_sources)
-
-        modules = {cs.name: compile_module(cs.node) for cs in checked_sources}
-        compiled_modules = {name: self._compile_module(name, module)
-                            for name, module in modules.items()}
-
-        for src in parsed_sources:
-            self._namespaces[src.name] = Namespace(src.name, src.modified_time,
-                                                   compiled_modules[src.name],
-                                                   src.dependencies)
-        self._reqs.update(refs)
+            reused = self._reusable(self._get_dependencies(ns), outdated)
+
+        loaded = self._load_cached(name)
+        if loaded is None:
+            loaded = self._compile(name, reused)
+
+        for namespace, compiled in loaded:
+            self._replace(namespace.name, namespace)
+            self._closures[namespace.name] = compiled.sources
+            self._reqs.update(compiled.reqs)
+        names = {namespace.name for namespace, _ in loaded}
+        self._invalidate(names)
+        self._link(names)
+
+    def _replace(self, name, namespace=None):
+        """Replaces or removes namespace and evicts its previous module"""
+        prev = self._namespaces.pop(name, None)
+        if namespace is not None:
+            self._namespaces[name] = namespace
+        if prev is not None and (namespace is None or
+                                 prev.module is not namespace.module):
+            evict(prev.module['__name__'])
+
+    def _invalidate(self, names):
+        """Removes namespaces, which were compiled with other versions of
+        the namespaces with specified names
+
+        Their modules are shared, so instead of linking them with new
+        versions, they are loaded again when used.
+        """
+        digests = {name: self._closures[name][name] for name in names}
+        for name, closure in list(self._closures.items()):
+            if name not in names and any(
+                closure.get(dep, digest) != digest
+                for dep, digest in digests.items()
+            ):
+                self._replace(name)
+                del self._closures[name]
 
     def _get_namespace(self, name):
         self._load(name)
@@ -231,12 +801,110 @@ class Lookup(object):
         self._load(ns)
         return self._reqs[name]
 
-    def _render(self, name, result):
-        ctx = Context(self, result)
+    def _render_key(self, name, result):
+        ns, _, _ = name.partition('/')
+        hash_ = hashlib.sha1()
+        # module name identifies compiled code of the namespace and of its
+        # dependencies
+        module_name = self._get_namespace(ns).module['__name__']
+        hash_.update('{}\0{}\0'.format(module_name, name).encode('utf-8'))
+        _fingerprint(hash_, result)
+        return hash_.hexdigest()
+
+    def _fragment_key(self, name, fn, args, result):
+        hash_ = hashlib.sha1()
+        hash_.update('{}\0{}\0'.format(fn.__globals__['__name__'], name)
+                     .encode('utf-8'))
+        _fingerprint(hash_, _project(self._reqs[name], result))
+        _fingerprint(hash_, list(args))
+        return hash_.hexdigest()
+
+    def _result_key(self, name, result, key):
+        """Returns key of the rendered content in the render cache or None,
+        when content shouldn't be cached
+        """
+        if self.render_cache is None:
+            return None
+        if key is None:
+            try:
+                key = self._render_key(name, result)
+            except TypeError:
+                # values, which can't be fingerprinted, aren't cached
+                return None
+        return key
+
+    def _render(self, name, result, key=None):
+        key = self._result_key(name, result, key)
+        if key is not None:
+            content = self.render_cache.get(key)
+            if content is None:
+                content = self._render_content(name, result)
+                self.render_cache.set(key, content)
+            return content
+        return self._render_content(name, result)
+
+    def _render_content(self, name, result):
+        ctx = Context(self, result, self.buffer_cls())
         ctx.buffer.push()
         fn = ctx.lookup(name)
         fn(ctx)
         return ctx.buffer.pop()
 
+    def _render_to(self, name, result, sink, chunk_size, key=None):
+        key = self._result_key(name, result, key)
+        if key is not None:
+            content = self.render_cache.get(key)
+            if content is not None:
+                for i in range(0, len(content), chunk_size):
+                    sink(text_type(content[i:i + chunk_size]))
+                return
+            chunks = []
+
+            def caching_sink(chunk):
+                chunks.append(chunk)
+                sink(chunk)
+
+            self._render_chunks(name, result, caching_sink, chunk_size)
+            self.render_cache.set(key, Markup(''.join(chunks)))
+        else:
+            self._render_chunks(name, result, sink, chunk_size)
+
+    def _render_chunks(self, name, result, sink, chunk_size):
+        ctx = Context(self, result, StreamingBuffer(sink, chunk_size))
+        ctx.buffer.push()
+        fn = ctx.lookup(name)
+        fn(ctx)
+        rest = ctx.buffer.pop()
+        if rest:
+            sink(text_type(rest))
+
+    def _names(self):
+        return self._loader.list()
+
+    def preload(self, names=None, freeze=True):
+        """Loads and compiles namespaces before they are used
+
+        Loads all available namespaces by default. Intended to be called in
+        the master process before forking workers: loaded objects are moved
+        into the permanent generation using `gc.freeze` (when available), so
+        garbage collection in the workers doesn't write into their memory
+        pages and they stay shared.
+        """
+        names = self._names() if names is None else names
+        for name in names:
+            self._load(name)
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+    def queries(self):
+        """Returns queries of all available functions"""
+        self.preload(freeze=False)
+        return dict(self._reqs)
+
     def get(self, name):
-        return Function(self, name)
+        try:
+            return self._functions[name]
+        except KeyError:
+            fn = self._functions[name] = Function(self, name)
+            return fn
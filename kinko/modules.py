@@ -0,0 +1,149 @@
+"""Import hook, which makes compiled namespaces real Python modules
+
+Compiled namespaces are imported as submodules of the `kinko_compiled`
+package using the standard import system. They are stored in the
+`sys.modules`, so lookups, which compiled the same code, are sharing them,
+and they are visible to the standard tools like profilers. Modules, built
+ahead of time, are loaded from files, so the import system caches their
+bytecode.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import hashlib
+import importlib
+import threading
+
+from .compat import _exec_in
+
+
+PACKAGE = 'kinko_compiled'
+
+
+def module_name(name, key):
+    """Returns full module name for the namespace
+
+    `key` should identify compiled code of the namespace, modules with equal
+    names are shared.
+    """
+    return '{}.{}_{}'.format(PACKAGE, re.sub(r'\W', '_', name), key[:16])
+
+
+def path_key(path):
+    """Returns key for the module, loaded from file"""
+    stat = os.stat(path)
+    key = '{}:{}:{}'.format(os.path.abspath(path), stat.st_mtime, stat.st_size)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class CompiledImporter(object):
+    """Finds and loads registered compiled namespaces
+
+    Implements PEP 302 protocol for Python 2 and PEP 451 protocol for
+    Python 3.
+    """
+
+    def __init__(self):
+        self._code = {}
+        self._paths = {}
+
+    def register_code(self, fullname, code):
+        self._code[fullname] = code
+
+    def register_path(self, fullname, path):
+        self._paths.setdefault(fullname, path)
+
+    def unregister(self, fullname):
+        self._code.pop(fullname, None)
+        self._paths.pop(fullname, None)
+
+    def _is_registered(self, fullname):
+        return (fullname == PACKAGE or fullname in self._code or
+                fullname in self._paths)
+
+    def find_module(self, fullname, path=None):
+        return self if self._is_registered(fullname) else None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        if fullname in self._paths:
+            import imp
+            return imp.load_source(fullname, self._paths[fullname])
+        module = _new_module(fullname)
+        module.__loader__ = self
+        sys.modules[fullname] = module
+        try:
+            self._exec(module)
+        except Exception:
+            del sys.modules[fullname]
+            raise
+        return module
+
+    def find_spec(self, fullname, path=None, target=None):
+        from importlib.util import spec_from_file_location, spec_from_loader
+        if fullname in self._paths:
+            return spec_from_file_location(fullname, self._paths[fullname])
+        elif self._is_registered(fullname):
+            return spec_from_loader(fullname, self,
+                                    is_package=fullname == PACKAGE)
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        self._exec(module)
+
+    def _exec(self, module):
+        if module.__name__ == PACKAGE:
+            module.__path__ = []
+        else:
+            code = self._code.pop(module.__name__)
+            module.__file__ = code.co_filename
+            _exec_in(code, module.__dict__)
+
+
+def _new_module(name):
+    return type(sys)(name)
+
+
+_importer = CompiledImporter()
+_lock = threading.Lock()
+
+
+def _install():
+    with _lock:
+        if _importer not in sys.meta_path:
+            sys.meta_path.append(_importer)
+
+
+def import_code(fullname, code):
+    """Returns module with specified name, executes `code` in it only when
+    this module wasn't imported before
+    """
+    module = sys.modules.get(fullname)
+    if module is None:
+        _install()
+        _importer.register_code(fullname, code)
+        module = importlib.import_module(fullname)
+    return module
+
+
+def import_path(fullname, path):
+    """Returns module with specified name, loaded from the `path` file"""
+    _install()
+    _importer.register_path(fullname, path)
+    return importlib.import_module(fullname)
+
+
+def evict(fullname):
+    """Removes module from the import system, so it will be garbage
+    collected, when it is not used anymore
+    """
+    _importer.unregister(fullname)
+    sys.modules.pop(fullname, None)
+    package = sys.modules.get(PACKAGE)
+    if package is not None:
+        vars(package).pop(fullname.rpartition('.')[2], None)
@@ -2,11 +2,53 @@ from itertools import chain
 from collections import defaultdict
 
 
-class Field(object):
+class _Immutable(object):
+    """Queries are shared between functions, lookups and threads, so they
+    can't be modified after they were created
+    """
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def _key(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.options == other.options and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((type(self).__name__, self._key()))
+
+
+class _FrozenDict(dict):
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{} is immutable'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+class Field(_Immutable):
 
     def __init__(self, name, options=None):
-        self.name = name
-        self.options = options
+        super(Field, self).__init__(name=name, options=options)
+
+    def _key(self):
+        return self.name
 
     def __repr__(self):
         return ':{}'.format(self.name)
@@ -15,12 +57,13 @@ class Field(object):
         return visitor.visit_field(self)
 
 
-class Link(object):
+class Link(_Immutable):
 
     def __init__(self, name, edge, options=None):
-        self.name = name
-        self.edge = edge
-        self.options = options
+        super(Link, self).__init__(name=name, edge=edge, options=options)
+
+    def _key(self):
+        return self.name, self.edge
 
     def __repr__(self):
         return '{{:{} {!r}}}'.format(self.name, self.edge)
@@ -29,17 +72,36 @@ class Link(object):
         return visitor.visit_link(self)
 
 
-class Edge(object):
+class Edge(_Immutable):
 
     def __init__(self, fields):
-        self.fields = {field.name: field for field in fields}
+        super(Edge, self).__init__(fields=_FrozenDict((field.name, field)
+                                                      for field in fields),
+                                   options=None)
 
-    def add(self, field):
-        return self.fields.setdefault(field.name, field)
+    def _key(self):
+        return frozenset(self.fields.values())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_dumps', None)
+        return state
 
     def __repr__(self):
         return '[{}]'.format(' '.join(map(repr, self.fields.values())))
 
+    def dumps(self):
+        """Returns query in the wire format (EDN), encoded using UTF-8
+
+        Result is memoized, because the same query is sent to the backend
+        on every request to the function.
+        """
+        try:
+            return self.__dict__['_dumps']
+        except KeyError:
+            data = self.__dict__['_dumps'] = repr(self).encode('utf-8')
+            return data
+
     def accept(self, visitor):
         return visitor.visit_edge(self)
 
@@ -210,7 +210,16 @@ def _yield_queries(mapping, func_name):
                 yield item
 
 
+def queries(refs, names):
+    """Builds queries for functions with specified names
+
+    `refs` should also contain references of all the functions, which are
+    called by these functions.
+    """
+    return {name: merge(_yield_queries(refs, name))
+            for name in names}
+
+
 def extract(node):
     refs = RefsCollector.collect(node)
-    return {name: merge(_yield_queries(refs, name))
-            for name in refs}
+    return queries(refs, refs)
@@ -1,16 +1,21 @@
+import time
 import uuid
+import asyncio
 from html import escape
 from logging import getLogger
 from traceback import format_exc
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 from aiohttp.web import Application, Response, run_app, HTTPException
+from aiohttp.web import StreamResponse
 
 from .ext import load_extensions
 from .types import Func, StringType
-from .lookup import Lookup
-from .loaders import FileSystemLoader
+from .build import CompiledLookup
+from .lookup import Lookup, RenderCache
+from .loaders import FileSystemLoader, FileSystemCache
+from .loaders import WatchingFileSystemLoader
 from .typedef import load_types
 from .read.simple import loads
 
@@ -31,62 +36,213 @@ def static_url(path):
     return '/{}/{}'.format(STATIC_PREFIX, path)
 
 
+def _max_age(cache_control):
+    """Returns max-age from the Cache-Control header value, 0 if response
+    shouldn't be cached or None if there are no hints
+    """
+    max_age = None
+    for directive in cache_control.lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        if name in ('no-store', 'no-cache'):
+            return 0
+        elif name == 'max-age':
+            try:
+                max_age = max(int(value), 0)
+            except ValueError:
+                return 0
+    return max_age
+
+
+class ResolveCache(object):
+    """Holds at most `maxsize` recently used url resolution results
+
+    Results expire after `ttl` seconds, "not found" results expire after
+    `negative_ttl` seconds, other errors aren't cached. Backend may override
+    expiration time using Cache-Control header.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, negative_ttl=10,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._cache = OrderedDict()
+
+    def get(self, url):
+        try:
+            result, expires = self._cache.pop(url)
+        except KeyError:
+            return None
+        if expires <= self._clock():
+            return None
+        self._cache[url] = result, expires
+        return result
+
+    def set(self, url, result, max_age=None):
+        if max_age is not None:
+            ttl = max_age
+        elif result.status == 200:
+            ttl = self.ttl
+        elif result.status == 404:
+            ttl = self.negative_ttl
+        else:
+            ttl = 0
+        self._cache.pop(url, None)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._cache[url] = result, self._clock() + ttl
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
 class Backend(object):
+    """Client for the backend API
 
-    def __init__(self, base_url, *, loop):
+    Uses single long-lived session, so connections to the backend are
+    pooled and kept alive between requests. `close` should be called when
+    backend is not needed anymore.
+
+    Backend may also support combined requests: queries of all endpoints
+    are registered once using `POST queries` request, then `GET
+    resolve-pull` request resolves url and returns result of the endpoint's
+    query, with resolved status and endpoint in the `X-Kinko-Status` and
+    `X-Kinko-Endpoint` headers.
+
+    Resolution results are cached in the `resolve_cache`, if specified.
+    """
+
+    def __init__(self, base_url, *, loop, pool_size=100, keepalive_timeout=30,
+                 timeout=None, resolve_cache=None):
         self.base_url = base_url
         self.loop = loop
+        self.resolve_cache = resolve_cache
+        connector = TCPConnector(limit=pool_size,
+                                 keepalive_timeout=keepalive_timeout,
+                                 loop=loop)
+        self._session = ClientSession(connector=connector, loop=loop,
+                                      conn_timeout=timeout,
+                                      read_timeout=timeout)
 
     def _url(self, path):
         return self.base_url + path
 
+    async def close(self):
+        await self._session.close()
+
     async def types(self):
         url = self._url('types')
-        with ClientSession(loop=self.loop) as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    types = load_types(data.decode('utf-8'))
-                    return types
-                else:
-                    raise Exception(repr(resp))
+        async with self._session.get(url) as resp:
+            if resp.status == 200:
+                data = await resp.read()
+                types = load_types(data.decode('utf-8'))
+                return types
+            else:
+                raise Exception(repr(resp))
+
+    def cached_resolve(self, url):
+        """Returns cached resolution result or None"""
+        if self.resolve_cache is not None:
+            return self.resolve_cache.get(url)
+
+    def _cache_resolve(self, url, resolved, headers):
+        if self.resolve_cache is not None:
+            cache_control = headers.get('Cache-Control')
+            max_age = _max_age(cache_control) if cache_control else None
+            self.resolve_cache.set(url, resolved, max_age)
 
     async def resolve(self, url):
+        resolved = self.cached_resolve(url)
+        if resolved is not None:
+            return resolved
         _url = self._url('resolve')
         params = {'url': url}
-        with ClientSession(loop=self.loop) as session:
-            async with session.get(_url, params=params) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    return ResolveResult(result['status'],
+        async with self._session.get(_url, params=params) as resp:
+            if resp.status == 200:
+                result = await resp.json()
+                resolved = ResolveResult(result['status'],
                                          result.get('endpoint'))
-                else:
-                    raise Exception(repr(resp))
+                self._cache_resolve(url, resolved, resp.headers)
+                return resolved
+            else:
+                raise Exception(repr(resp))
+
+    async def register(self, queries):
+        """Registers queries of all endpoints for combined requests
+
+        Returns False if backend doesn't support combined requests.
+        """
+        _url = self._url('queries')
+        data = '{{{}}}'.format(' '.join(
+            '"{}" {}'.format(name, query.dumps().decode('utf-8'))
+            for name, query in sorted(queries.items())
+        ))
+        headers = {'Content-Type': 'application/edn'}
+        async with self._session.post(_url, data=data.encode('utf-8'),
+                                      headers=headers) as resp:
+            if resp.status == 200:
+                return True
+            elif resp.status == 404:
+                return False
+            else:
+                raise Exception(repr(resp))
+
+    async def resolve_pull(self, url):
+        """Resolves url and pulls result for the registered query of the
+        resolved endpoint in a single request
+        """
+        _url = self._url('resolve-pull')
+        params = {'url': url}
+        async with self._session.get(_url, params=params) as resp:
+            if resp.status == 200:
+                resolved = ResolveResult(int(resp.headers['X-Kinko-Status']),
+                                         resp.headers.get('X-Kinko-Endpoint'))
+                # Cache-Control header of this response describes data
+                self._cache_resolve(url, resolved, {})
+                result = None
+                if resolved.status == 200:
+                    resp_data = await resp.read()
+                    result = loads(resp_data.decode('utf-8'))
+                return resolved, result
+            else:
+                raise Exception(repr(resp))
 
     async def pull(self, query, url):
         _url = self._url('pull')
-        data = repr(query)
+        data = query.dumps()
         params = {'url': url}
         headers = {'Content-Type': 'application/edn'}
-        with ClientSession(loop=self.loop) as session:
-            async with session.post(_url, data=data, params=params,
-                                    headers=headers) as resp:
-                if resp.status == 200:
-                    resp_data = await resp.read()
-                    result = loads(resp_data.decode('utf-8'))
-                    return result
-                else:
-                    raise Exception(repr(resp))
+        async with self._session.post(_url, data=data, params=params,
+                                      headers=headers) as resp:
+            if resp.status == 200:
+                resp_data = await resp.read()
+                result = loads(resp_data.decode('utf-8'))
+                return result
+            else:
+                raise Exception(repr(resp))
 
 
 def get_backend(app):
     backend = app.get('_backend', None)
     if backend is None:
-        base_url = app['BASE_URL']
-        backend = app['_backend'] = Backend(base_url, loop=app.loop)
+        backend = app['_backend'] = Backend(
+            app['BASE_URL'], loop=app.loop,
+            pool_size=app['BACKEND_POOL_SIZE'],
+            keepalive_timeout=app['BACKEND_KEEPALIVE'],
+            timeout=app['BACKEND_TIMEOUT'],
+            resolve_cache=ResolveCache(app['RESOLVE_CACHE_SIZE'],
+                                       app['RESOLVE_TTL'],
+                                       app['RESOLVE_NEGATIVE_TTL']),
+        )
     return backend
 
 
+async def close_backend(app):
+    backend = app.pop('_backend', None)
+    if backend is not None:
+        await backend.close()
+
+
 async def get_lookup(app):
     lookup = app.get('_lookup', None)
     if lookup is None:
@@ -100,29 +256,148 @@ async def get_lookup(app):
         builtins = app['BUILTINS']
         builtins.update({f.__defn_name__: f for f in extensions})
 
-        loader = FileSystemLoader(app['UI_PATH'])
-        lookup = app['_lookup'] = Lookup(types, loader, builtins=builtins)
+        render_cache = None
+        if app['RENDER_CACHE_SIZE']:
+            render_cache = RenderCache(app['RENDER_CACHE_SIZE'])
+
+        if app['COMPILED_PATH']:
+            lookup = app['_lookup'] = CompiledLookup(
+                app['COMPILED_PATH'], builtins=builtins,
+                render_cache=render_cache,
+            )
+            return lookup
+
+        # compiled namespaces are also kept in the process-wide registry
+        cache = None
+        if app['CACHE_PATH']:
+            cache = FileSystemCache(app['CACHE_PATH'])
+
+        if app['WATCH']:
+            loader = WatchingFileSystemLoader(app['UI_PATH'])
+        else:
+            loader = FileSystemLoader(app['UI_PATH'],
+                                      check_interval=app['CHECK_INTERVAL'],
+                                      immutable=app['IMMUTABLE'])
+        lookup = app['_lookup'] = Lookup(types, loader, cache=cache,
+                                         builtins=builtins, shared=True,
+                                         render_cache=render_cache)
     return lookup
 
 
+async def _register(app):
+    if not app['COMBINED'] or not (app['COMPILED_PATH'] or app['IMMUTABLE']):
+        return False
+    lookup = await get_lookup(app)
+    try:
+        # loads and compiles all namespaces, so it is done in the thread
+        queries = await app.loop.run_in_executor(None, lookup.queries)
+        return await get_backend(app).register(queries)
+    except Exception:
+        log.exception('Failed to register queries, combined requests are '
+                      'disabled')
+        return False
+
+
+async def use_combined(app):
+    """Registers queries of all endpoints in the backend, when templates
+    can't change, returns True if backend supports combined requests
+
+    Registration is done once, concurrent requests are waiting for it.
+    """
+    registration = app.get('_combined', None)
+    if registration is None:
+        registration = app['_combined'] = asyncio.ensure_future(
+            _register(app), loop=app.loop)
+    # cancelled request shouldn't cancel registration for other requests
+    return await asyncio.shield(registration, loop=app.loop)
+
+
 async def request_handler(request):
     url = current_url(request)
 
     backend = get_backend(request.app)
+    lookup = await get_lookup(request.app)
+
+    # cached resolution results make combined request unnecessary
+    cached = backend.cached_resolve(url) is not None
+    if not cached and await use_combined(request.app):
+        (status, endpoint), result = await backend.resolve_pull(url)
+        if status != 200:
+            return Response(status=status,
+                            text='HTTP Error {}'.format(status))
+        fn = lookup.get(endpoint)
+        log.info('%s (combined)', endpoint)
+    else:
+        status, endpoint = await backend.resolve(url)
+        if status != 200:
+            return Response(status=status,
+                            text='HTTP Error {}'.format(status))
+
+        fn = lookup.get(endpoint)
+
+        query = fn.query()
+        log.info('%s %r', endpoint, query)
+
+        result = await backend.pull(query, url)
+
+    fingerprint = None
+    if lookup.render_cache is not None:
+        try:
+            fingerprint = fn.fingerprint(result)
+        except TypeError:
+            log.debug('Result of %s can not be cached', endpoint)
+        else:
+            etag = '"{}"'.format(fingerprint)
+            if _etag_matches(request.headers.get('If-None-Match'), etag):
+                return Response(status=304, headers={'ETag': etag})
+
+    return await stream_render(request, fn, result, fingerprint)
 
-    status, endpoint = await backend.resolve(url)
-    if status != 200:
-        return Response(status=status,
-                        text='HTTP Error {}'.format(status))
 
-    fn = (await get_lookup(request.app)).get(endpoint)
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
 
-    log.info('%s %r', endpoint, fn.query())
 
-    result = await backend.pull(fn.query(), url)
+async def stream_render(request, fn, result, fingerprint=None):
+    """Renders page in a thread and sends it to the client in chunks
 
-    return Response(text=fn.render(result),
-                    headers={'Content-Type': 'text/html'})
+    Response is started only after first chunk is rendered, so errors
+    occurred before that are handled as usual. `fingerprint` of the result
+    is used as a render cache key and as an ETag.
+    """
+    loop = request.app.loop
+    chunks = asyncio.Queue(loop=loop)
+
+    def sink(chunk):
+        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+    def render():
+        try:
+            fn.render_to(result, sink, fingerprint=fingerprint)
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    rendering = loop.run_in_executor(None, render)
+
+    chunk = await chunks.get()
+    if chunk is None:
+        await rendering
+
+    headers = {'Content-Type': 'text/html'}
+    if fingerprint is not None:
+        headers['ETag'] = '"{}"'.format(fingerprint)
+    resp = StreamResponse(headers=headers)
+    await resp.prepare(request)
+    while chunk is not None:
+        resp.write(chunk.encode('utf-8'))
+        await resp.drain()
+        chunk = await chunks.get()
+    await rendering
+    await resp.write_eof()
+    return resp
 
 
 ERROR_TEMPLATE = """
@@ -155,13 +430,30 @@ async def error_middleware(app, handler):
 
 
 def main(host, port, base_url, ui_path, static_path=None, debug=True,
-         extensions=None):
+         extensions=None, cache_path=None, check_interval=None,
+         immutable=False, watch=False, compiled_path=None,
+         backend_pool_size=100, backend_keepalive=30, backend_timeout=None,
+         combined=True, resolve_cache_size=1024, resolve_ttl=60,
+         resolve_negative_ttl=10, render_cache_size=None):
     base_url += ('/' if not base_url.endswith('/') else '')
     middlewares = [error_middleware] if debug else []
 
     app = Application(middlewares=middlewares)
     app['BASE_URL'] = base_url
+    app['BACKEND_POOL_SIZE'] = backend_pool_size
+    app['BACKEND_KEEPALIVE'] = backend_keepalive
+    app['BACKEND_TIMEOUT'] = backend_timeout
+    app['COMBINED'] = combined
+    app['RESOLVE_CACHE_SIZE'] = resolve_cache_size
+    app['RESOLVE_TTL'] = resolve_ttl
+    app['RESOLVE_NEGATIVE_TTL'] = resolve_negative_ttl
+    app['RENDER_CACHE_SIZE'] = render_cache_size
     app['UI_PATH'] = ui_path
+    app['CACHE_PATH'] = cache_path
+    app['CHECK_INTERVAL'] = check_interval
+    app['IMMUTABLE'] = immutable
+    app['WATCH'] = watch
+    app['COMPILED_PATH'] = compiled_path
     app['EXTENSIONS'] = load_extensions(extensions or [])
 
     types = app['TYPES'] = {}
@@ -173,5 +465,6 @@ def main(host, port, base_url, ui_path, static_path=None, debug=True,
 
     app.router.add_route('GET', '/', request_handler)
     app.router.add_route('GET', '/{path:.+}', request_handler)
+    app.on_cleanup.append(close_backend)
 
     run_app(app, host=host, port=port)
@@ -1,6 +1,7 @@
 import io
+import re
 from contextlib import contextmanager
-from collections import Counter
+from collections import Counter, OrderedDict
 
 from markupsafe import Markup, escape
 
@@ -9,7 +10,26 @@ from .types import TypeVar, NamedArgMeta, VarArgsMeta, VarNamedArgsMeta
 from .compat import text_type
 
 
+_ESCAPE_RE = re.compile(r'[&<>"\']')
+
+
+def escape_text(s):
+    """Escapes value in the same way as `markupsafe.escape` does
+
+    Text without special characters is returned as is and escaped text is
+    returned without wrapping it into the `Markup` object.
+    """
+    if type(s) is text_type:
+        if _ESCAPE_RE.search(s) is None:
+            return s
+        return (s.replace('&', '&amp;').replace('<', '&lt;')
+                .replace('>', '&gt;').replace('"', '&#34;')
+                .replace("'", '&#39;'))
+    return escape(s)
+
+
 class Buffer(object):
+    escape = staticmethod(escape_text)
 
     def __init__(self):
         self.stack = []
@@ -18,7 +38,7 @@ class Buffer(object):
         self.stack[-1].write(text_type(s))
 
     def write_unsafe(self, s):
-        self.stack[-1].write(escape(s))
+        self.stack[-1].write(escape_text(s))
 
     def write_optional(self, s):
         if s is not None:
@@ -26,7 +46,20 @@ class Buffer(object):
 
     def write_optional_unsafe(self, s):
         if s is not None:
-            self.stack[-1].write(escape(s))
+            self.stack[-1].write(escape_text(s))
+
+    def write_markup(self, s):
+        if callable(s):
+            s()
+        else:
+            self.write_optional_unsafe(s)
+
+    def render_markup(self, s):
+        if callable(s):
+            self.push()
+            s()
+            return self.pop()
+        return s
 
     def push(self):
         self.stack.append(io.StringIO())
@@ -34,6 +67,80 @@ class Buffer(object):
     def pop(self):
         return Markup(self.stack.pop().getvalue())
 
+    def flush(self):
+        pass
+
+
+class ListBuffer(Buffer):
+    """Buffer, which collects written fragments into lists
+
+    Fragments are joined only once, when content is popped. Append method
+    of the current list is cached to avoid stack lookups on every write.
+    """
+
+    def __init__(self):
+        super(ListBuffer, self).__init__()
+        self._append = None
+
+    def write(self, s):
+        self._append(text_type(s))
+
+    def write_unsafe(self, s):
+        self._append(escape_text(s))
+
+    def write_optional(self, s):
+        if s is not None:
+            self._append(text_type(s))
+
+    def write_optional_unsafe(self, s):
+        if s is not None:
+            self._append(escape_text(s))
+
+    def push(self):
+        chunks = []
+        self.stack.append(chunks)
+        self._append = chunks.append
+
+    def pop(self):
+        value = Markup(''.join(self.stack.pop()))
+        self._append = self.stack[-1].append if self.stack else None
+        return value
+
+
+class StreamingBuffer(Buffer):
+    """Buffer, which sends rendered content to the `sink` in chunks
+
+    Content is sent after writes, only when it is not captured to be passed
+    as an argument and when it is at least `chunk_size` characters long, so
+    compiled code doesn't need to know whether it is streamed or not.
+    """
+
+    def __init__(self, sink, chunk_size=4096):
+        super(StreamingBuffer, self).__init__()
+        self.sink = sink
+        self.chunk_size = chunk_size
+
+    def write(self, s):
+        super(StreamingBuffer, self).write(s)
+        self.flush()
+
+    def write_unsafe(self, s):
+        super(StreamingBuffer, self).write_unsafe(s)
+        self.flush()
+
+    def write_optional(self, s):
+        super(StreamingBuffer, self).write_optional(s)
+        self.flush()
+
+    def write_optional_unsafe(self, s):
+        super(StreamingBuffer, self).write_optional_unsafe(s)
+        self.flush()
+
+    def flush(self):
+        if len(self.stack) == 1 and self.stack[0].tell() >= self.chunk_size:
+            self.sink(self.stack[0].getvalue())
+            self.stack[0] = io.StringIO()
+
 
 class VarsGen(object):
 
@@ -47,7 +154,8 @@ class VarsGen(object):
 
 
 def split_args(args):
-    _pos_args, _kw_args = [], {}
+    # named arguments are kept in the source order to generate the same code
+    _pos_args, _kw_args = [], OrderedDict()
     i = iter(args)
     try:
         while True:
@@ -66,7 +174,7 @@ def split_args(args):
 
 
 def normalize_args(fn_type, pos_args, kw_args):
-    pos_args, kw_args = list(pos_args), dict(kw_args)
+    pos_args, kw_args = list(pos_args), OrderedDict(kw_args)
     norm_args = []
     missing_arg = False
     for arg_type in fn_type.__args__:
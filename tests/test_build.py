@@ -0,0 +1,109 @@
+import os.path
+import shutil
+import tempfile
+
+from kinko.build import build, components, CompiledLookup
+from kinko.lookup import FragmentCache
+from kinko.errors import UserError
+
+from .base import TestCase
+
+
+TYPES_SRC = """\
+type value String
+"""
+
+A_SRC = """\
+def foo
+  b/bar
+    :arg
+      span value
+"""
+
+B_SRC = """\
+def bar
+  div #arg
+"""
+
+
+class TestBuild(TestCase):
+
+    def setUp(self):
+        self.ui_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.ui_path)
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path)
+        self.write('a', A_SRC)
+        self.write('b', B_SRC)
+
+    def write(self, name, content):
+        file_path = os.path.join(self.ui_path, '{}.kinko'.format(name))
+        with open(file_path, 'w') as f:
+            f.write(content)
+
+    def check(self, jobs):
+        names = build(self.ui_path, self.output_path, TYPES_SRC, jobs=jobs)
+        self.assertEqual(names, ['a', 'b', 'c'])
+        module_path = os.path.join(self.output_path, 'a.py')
+        self.assertTrue(os.path.exists(module_path))
+        lookup = CompiledLookup(self.output_path)
+        fn = lookup.get('a/foo')
+        self.assertEqual(fn.render({'value': 'test'}),
+                         '<div><span>test</span></div>')
+        self.assertEqual(repr(fn.query()), '[:value]')
+        self.assertEqual(lookup._get_namespace('a').dependencies, {'b'})
+
+    def testBuild(self):
+        self.write('c', 'def baz\n  p "baz"\n')
+        self.check(1)
+
+    def testParallelBuild(self):
+        self.write('c', 'def baz\n  p "baz"\n')
+        self.check(2)
+        fn = CompiledLookup(self.output_path).get('c/baz')
+        self.assertEqual(fn.render({}), '<p>baz</p>')
+
+    def testPreload(self):
+        self.write('c', 'def baz\n  p "baz"\n')
+        build(self.ui_path, self.output_path, TYPES_SRC)
+        lookup = CompiledLookup(self.output_path)
+        lookup.preload(freeze=False)
+        self.assertEqual(set(lookup._namespaces), {'a', 'b', 'c'})
+
+    def testErrors(self):
+        self.write('c', 'def baz\n  p unknown1\n')
+        self.write('d', 'def qux\n  p unknown2\n')
+        with self.assertRaises(UserError) as ctx:
+            build(self.ui_path, self.output_path, TYPES_SRC, jobs=2)
+        message = str(ctx.exception)
+        self.assertIn('unknown1', message)
+        self.assertIn('unknown2', message)
+        self.assertLess(message.index('unknown1'), message.index('unknown2'))
+
+    def testMissingDependency(self):
+        self.write('c', 'def baz\n  x/qux\n')
+        with self.assertRaises(UserError) as ctx:
+            build(self.ui_path, self.output_path, TYPES_SRC, jobs=1)
+        self.assertIn('"x"', str(ctx.exception))
+
+    def testCompiledMissingDependency(self):
+        build(self.ui_path, self.output_path, TYPES_SRC, jobs=1)
+        os.unlink(os.path.join(self.output_path, 'b.py'))
+        lookup = CompiledLookup(self.output_path)
+        with self.assertRaises(UserError):
+            lookup.get('a/foo').render({'value': 'test'})
+        self.assertIsNone(lookup.render_cache)
+        self.assertEqual(lookup._namespaces, {})
+
+    def testCompiledFragments(self):
+        build(self.ui_path, self.output_path, TYPES_SRC, jobs=1)
+        with self.assertRaises(ValueError):
+            CompiledLookup(self.output_path,
+                           fragments=FragmentCache(['a/foo']))
+
+    def testComponents(self):
+        self.assertEqual(
+            components({'a': {'b'}, 'b': set(), 'c': {'b'}, 'd': set(),
+                        'e': {'f'}, 'f': {'e'}}),
+            [['a', 'b', 'c'], ['e', 'f'], ['d']],
+        )
@@ -0,0 +1,162 @@
+import time
+import os.path
+import shutil
+import tempfile
+
+from kinko.lookup import Namespace
+from kinko.loaders import LRUCache, TieredCache, DictCache, NamespaceNotFound
+from kinko.loaders import FileSystemLoader, WatchingFileSystemLoader
+
+from .base import TestCase, patch
+
+
+class TestCaches(TestCase):
+
+    def testLRUCache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        with self.assertRaises(NamespaceNotFound):
+            cache.get('b')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def testTieredCache(self):
+        local, shared = LRUCache(), DictCache()
+        shared.set('a', 1)
+        cache = TieredCache(local, shared)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(local.get('a'), 1)
+        cache.set('b', 2)
+        self.assertEqual(local.get('b'), 2)
+        self.assertEqual(shared.get('b'), 2)
+        with self.assertRaises(NamespaceNotFound):
+            cache.get('c')
+
+
+class TestFileSystemLoader(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, 'a.kinko'), 'w') as f:
+            f.write('def foo\n  div\n')
+
+    def namespace(self, loader):
+        source = loader.load('a')
+        return Namespace('a', source.modified_time, None, None, set(), None,
+                         None)
+
+    def testCheckEveryTime(self):
+        loader = FileSystemLoader(self.path)
+        ns = self.namespace(loader)
+        with patch('os.path.getmtime') as getmtime:
+            getmtime.return_value = ns.modified_time
+            self.assertEqual(loader.outdated([ns, ns]), set())
+        self.assertEqual(getmtime.call_count, 2)
+
+    def testCheckInterval(self):
+        loader = FileSystemLoader(self.path, check_interval=10)
+        with patch('time.time') as time:
+            time.return_value = 100
+            ns = self.namespace(loader)
+            with patch('os.path.getmtime') as getmtime:
+                time.return_value = 105
+                self.assertTrue(loader.is_uptodate(ns))
+                self.assertFalse(getmtime.called)
+
+                getmtime.return_value = ns.modified_time
+                time.return_value = 111
+                self.assertTrue(loader.is_uptodate(ns))
+                time.return_value = 115
+                self.assertTrue(loader.is_uptodate(ns))
+                self.assertEqual(getmtime.call_count, 1)
+
+                getmtime.return_value = ns.modified_time + 1
+                time.return_value = 122
+                self.assertFalse(loader.is_uptodate(ns))
+
+    def testImmutable(self):
+        loader = FileSystemLoader(self.path, immutable=True)
+        ns = self.namespace(loader)
+        with patch('os.path.getmtime') as getmtime:
+            self.assertTrue(loader.is_uptodate(ns))
+            self.assertEqual(loader.outdated(iter([ns])), set())
+        self.assertFalse(getmtime.called)
+
+
+class TestWatchingFileSystemLoader(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.write('def foo\n  div\n')
+
+    def write(self, content):
+        with open(os.path.join(self.path, 'a.kinko'), 'w') as f:
+            f.write(content)
+
+    def assertChanged(self, loader):
+        source = loader.load('a')
+        ns = Namespace('a', source.modified_time, None, None, set(), None,
+                       None)
+        self.assertEqual(loader.outdated([ns]), set())
+
+        self.write('def foo\n  span\n')
+        os.utime(os.path.join(self.path, 'a.kinko'),
+                 (source.modified_time + 1, source.modified_time + 1))
+        for _ in range(500):
+            if loader.outdated([ns]):
+                break
+            time.sleep(0.01)
+        self.assertEqual(loader.outdated([ns]), {'a'})
+        self.assertFalse(loader.is_uptodate(ns))
+
+        # late events of the same change (e.g. utime after write) may mark
+        # namespace as dirty again, so waiting until watcher settles down
+        time.sleep(0.1)
+        for _ in range(10):
+            loader.load('a')
+            if loader.is_uptodate(ns):
+                break
+            time.sleep(0.1)
+        self.assertTrue(loader.is_uptodate(ns))
+
+    def testInotify(self):
+        loader = WatchingFileSystemLoader(self.path, poll_interval=0.01)
+        self.addCleanup(loader.close)
+        self.assertChanged(loader)
+
+    def testPolling(self):
+        loader = WatchingFileSystemLoader(self.path, poll_interval=0.01,
+                                          use_inotify=False)
+        self.addCleanup(loader.close)
+        self.assertChanged(loader)
+
+    def testWatchError(self):
+        error = [OSError('watch failed')]
+
+        def changed_names():
+            if error:
+                raise error.pop()
+            return poll()
+
+        loader = WatchingFileSystemLoader(self.path, poll_interval=0.01,
+                                          use_inotify=False)
+        self.addCleanup(loader.close)
+        source = loader.load('a')
+        poll = loader._poll
+        ns = Namespace('a', source.modified_time, None, None, set(), None,
+                       None)
+        with patch('kinko.loaders.log') as log, \
+                patch.object(loader, '_changed_names', changed_names):
+            for _ in range(500):
+                if loader.outdated([ns]):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(loader.outdated([ns]), {'a'})
+        self.assertTrue(log.exception.called)
+        loader.load('a')
+        self.assertChanged(loader)
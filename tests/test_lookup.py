@@ -1,10 +1,21 @@
+import sys
+import os.path
 import types
+import shutil
+import tempfile
+import threading
 
-from kinko.types import StringType
-from kinko.lookup import Lookup
-from kinko.loaders import DictLoader
+from markupsafe import Markup
 
-from .base import TestCase
+from kinko.types import StringType, IntType, BoolType, ListType, Record
+from kinko.types import Func
+from kinko.utils import ListBuffer
+from kinko.lookup import Lookup, RenderCache, FragmentCache
+from kinko.loaders import DictLoader, FileSystemLoader, FileSystemCache
+from kinko.compile.python import link_name
+from kinko.read.result import Result
+
+from .base import TestCase, patch
 
 
 A_SRC = """\
@@ -48,11 +59,103 @@ class TestLoadCode(TestCase):
         self.assertEqual(set(self.lookup._namespaces.keys()), {'a', 'b'})
         self.assertIsInstance(ns.module['foo'], types.FunctionType)
 
+    def testLinks(self):
+        a_module = self.lookup._get_namespace('a').module
+        b_module = self.lookup._get_namespace('b').module
+        self.assertIs(a_module[link_name('b/bar')], b_module['bar'])
+        fn = self.lookup.get('a/foo')
+        with patch.object(self.lookup, '_get_namespace',
+                          wraps=self.lookup._get_namespace) as get_ns:
+            fn.render({'value': 'test'})
+        get_ns.assert_called_once_with('a')
+
     def testRender(self):
         fn = self.lookup.get('a/foo')
         content = fn.render({'value': 'test'})
         self.assertEqual(content, '<div><span>test</span></div>')
 
+    def testQueries(self):
+        queries = self.lookup.queries()
+        self.assertEqual({name: repr(query)
+                          for name, query in queries.items()},
+                         {'a/foo': '[:value]', 'b/bar': '[]'})
+
+    def testInlineLiteralArguments(self):
+        lookup = Lookup({}, DictLoader({'a': """\
+def w
+  span #x
+
+def page
+  div
+    ./w :x "literal"
+    ./w :x 5
+"""}))
+        self.assertEqual(lookup.get('a/page').render({}),
+                         '<div><span>literal</span><span>5</span></div>')
+
+    def testMissingBuiltin(self):
+        types_ = {'flag': BoolType, 'url': Func[[StringType], StringType]}
+        lookup = Lookup(types_, DictLoader({
+            'a': 'def foo\n  if flag\n    a :href (url "x")\n',
+        }))
+        fn = lookup.get('a/foo')
+        self.assertEqual(fn.render({'flag': False}), '')
+        with self.assertRaises(KeyError):
+            fn.render({'flag': True})
+
+    def testQueryCached(self):
+        fn = self.lookup.get('a/foo')
+        self.assertIs(self.lookup.get('a/foo'), fn)
+        query = fn.query()
+        with patch.object(self.lookup, '_get_query') as get_query:
+            self.assertIs(fn.query(), query)
+        self.assertFalse(get_query.called)
+
+    def testQueryImmutable(self):
+        loader = DictLoader({'a': A_SRC, 'b': B_SRC})
+        loader.immutable = True
+        lookup = Lookup({'value': StringType}, loader)
+        query = lookup.get('a/foo').query()
+        with patch.object(lookup, '_load') as load:
+            self.assertIs(lookup.get('a/foo').query(), query)
+        self.assertFalse(load.called)
+
+    def testSharedModules(self):
+        a_module = self.lookup._get_namespace('a').module
+        lookup = Lookup({'value': StringType}, self.lookup._loader)
+        self.assertIs(lookup._get_namespace('a').module, a_module)
+        module = sys.modules[a_module['__name__']]
+        self.assertEqual(module.foo.__module__, module.__name__)
+
+        other = Lookup({'value': IntType}, self.lookup._loader)
+        self.assertIsNot(other._get_namespace('a').module, a_module)
+
+    def testSharedRegistry(self):
+        lookup = Lookup({'value': StringType}, self.lookup._loader,
+                        shared=True)
+        query = lookup.get('a/foo').query()
+        with patch.object(Lookup, '_check') as check:
+            lookup = Lookup({'value': StringType}, self.lookup._loader,
+                            shared=True)
+            self.assertIs(lookup.get('a/foo').query(), query)
+            self.assertEqual(lookup.get('a/foo').render({'value': 'test'}),
+                             '<div><span>test</span></div>')
+        self.assertFalse(check.called)
+
+    def testNotShared(self):
+        self.lookup.get('a/foo').query()
+        with patch.object(Lookup, '_check', side_effect=Lookup._check,
+                          autospec=True) as check:
+            lookup = Lookup({'value': StringType}, self.lookup._loader)
+            lookup.get('a/foo').query()
+        self.assertTrue(check.called)
+
+    def testListBuffer(self):
+        lookup = Lookup({'value': StringType}, self.lookup._loader,
+                        buffer_cls=ListBuffer)
+        content = lookup.get('a/foo').render({'value': '<test>'})
+        self.assertEqual(content, '<div><span>&lt;test&gt;</span></div>')
+
     def testEscape(self):
         fn = self.lookup.get('a/foo')
         content = fn.render({
@@ -61,3 +164,322 @@ class TestLoadCode(TestCase):
         self.assertEqual(content,
                          ('<div><span>&lt;script&gt;alert(&#34;xss&#34;);'
                           '&lt;/script&gt;</span></div>'))
+
+
+class TestRenderCache(TestCase):
+
+    def setUp(self):
+        self.sources = {'a': A_SRC, 'b': B_SRC}
+        self.lookup = self.create_lookup()
+
+    def create_lookup(self):
+        return Lookup({'value': StringType}, DictLoader(self.sources),
+                      render_cache=RenderCache())
+
+    def testRender(self):
+        fn = self.lookup.get('a/foo')
+        content = fn.render({'value': 'test'})
+        with patch.object(self.lookup, '_render_content') as render:
+            self.assertEqual(fn.render({'value': 'test'}), content)
+            self.assertEqual(''.join(fn.render_iter({'value': 'test'},
+                                                    chunk_size=4)),
+                             content)
+        self.assertFalse(render.called)
+        self.assertEqual(fn.render({'value': 'other'}),
+                         '<div><span>other</span></div>')
+
+    def testRenderTo(self):
+        chunks = []
+        fn = self.lookup.get('a/foo')
+        fn.render_to({'value': 'test'}, chunks.append)
+        with patch.object(self.lookup, '_render_chunks') as render:
+            self.assertEqual(fn.render({'value': 'test'}), ''.join(chunks))
+        self.assertFalse(render.called)
+
+    def testFingerprint(self):
+        fn = self.lookup.get('a/foo')
+        self.assertEqual(fn.fingerprint({'x': 1, 'value': 'test'}),
+                         fn.fingerprint({'value': 'test', 'x': 1}))
+        self.assertNotEqual(fn.fingerprint({'value': 'test'}),
+                            fn.fingerprint({'value': 'other'}))
+        self.sources['b'] = 'def bar\n  p #arg\n'
+        other = self.create_lookup().get('a/foo')
+        self.assertNotEqual(fn.fingerprint({'value': 'test'}),
+                            other.fingerprint({'value': 'test'}))
+
+    def testFingerprintTypes(self):
+        fn = self.lookup.get('a/foo')
+        values = [None, True, 1, 1.5, u'1', Markup(u'1'), [1], [[1]],
+                  {u'1': 1}, {1: u'1'}, [u'1', u'2'], [u'1\x002']]
+        fingerprints = {fn.fingerprint({'x': value}) for value in values}
+        self.assertEqual(len(fingerprints), len(values))
+        result = Result({'user': {1: {'name': 'x'}}})
+        self.assertEqual(fn.fingerprint({'x': result.ref('user', 1)}),
+                         fn.fingerprint({'x': result.ref('user', 1)}))
+        self.assertNotEqual(fn.fingerprint({'x': result.ref('user', 1)}),
+                            fn.fingerprint({'x': result.ref('user', 2)}))
+        with self.assertRaises(TypeError):
+            fn.fingerprint({'x': object()})
+
+    def testNotFingerprinted(self):
+        fn = self.lookup.get('a/foo')
+        self.assertEqual(fn.render({'value': 'test', 'x': object()}),
+                         '<div><span>test</span></div>')
+        self.assertEqual(self.lookup.render_cache._cache, {})
+
+    def testRenderFingerprint(self):
+        fn = self.lookup.get('a/foo')
+        key = fn.fingerprint({'value': 'test'})
+        with patch.object(self.lookup, '_render_key') as render_key:
+            content = fn.render({'value': 'test'}, fingerprint=key)
+            fn.render_to({'value': 'test'}, lambda chunk: None,
+                         fingerprint=key)
+        self.assertFalse(render_key.called)
+        self.assertEqual(self.lookup.render_cache.get(key), content)
+
+    def testEviction(self):
+        cache = RenderCache(maxsize=10)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'y' * 4)
+        self.assertEqual(cache.get('a'), 'x' * 6)
+        cache.set('c', 'z' * 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x' * 6)
+        cache.set('d', 'w' * 11)
+        self.assertIsNone(cache.get('d'))
+
+
+FRAGMENTS_SRC = """\
+def header
+  h1 user.name
+
+def page
+  div
+    ./header
+    p value
+    b/bar
+      :arg
+        ./header
+"""
+
+
+class TestFragments(TestCase):
+
+    def setUp(self):
+        types_ = {
+            'value': StringType,
+            'user': Record[{'name': StringType, 'id': IntType}],
+        }
+        self.fragments = FragmentCache(['f/header'])
+        self.lookup = Lookup(types_, DictLoader({'f': FRAGMENTS_SRC,
+                                                 'b': B_SRC}),
+                             fragments=self.fragments)
+
+    def testRender(self):
+        fn = self.lookup.get('f/page')
+        result = {'value': 'v1', 'user': {'name': 'Foo', 'id': 1}}
+        content = '<div><h1>Foo</h1><p>{}</p><div><h1>Foo</h1></div></div>'
+        self.assertEqual(fn.render(result), content.format('v1'))
+        self.assertEqual((self.fragments.hits, self.fragments.misses),
+                         (1, 1))
+
+        # fields, which header doesn't read, don't invalidate its content
+        result = {'value': 'v2', 'user': {'name': 'Foo', 'id': 2}}
+        self.assertEqual(fn.render(result), content.format('v2'))
+        self.assertEqual((self.fragments.hits, self.fragments.misses),
+                         (3, 1))
+
+        result = {'value': 'v2', 'user': {'name': 'Bar', 'id': 2}}
+        self.assertEqual(fn.render(result),
+                         content.format('v2').replace('Foo', 'Bar'))
+        self.assertEqual((self.fragments.hits, self.fragments.misses),
+                         (4, 2))
+
+    def testNotShared(self):
+        module = self.lookup._get_namespace('f').module
+        self.assertIn('header__fragment', module)
+        lookup = Lookup(self.lookup.types, self.lookup._loader)
+        self.assertIsNot(lookup._get_namespace('f').module, module)
+        self.assertNotIn('header__fragment',
+                         lookup._get_namespace('f').module)
+
+
+class TestFileSystemCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.sources = {'a': A_SRC, 'b': B_SRC}
+        self.types = {'value': StringType}
+
+    def lookup(self, types_=None):
+        return Lookup(types_ or self.types, DictLoader(self.sources),
+                      cache=FileSystemCache(self.path))
+
+    def testColdStart(self):
+        fn = self.lookup().get('a/foo')
+        self.assertEqual(fn.render({'value': 'test'}),
+                         '<div><span>test</span></div>')
+
+        with patch.object(Lookup, '_check') as check:
+            lookup = self.lookup()
+            fn = lookup.get('a/foo')
+            self.assertEqual(fn.render({'value': 'test'}),
+                             '<div><span>test</span></div>')
+            self.assertEqual(repr(fn.query()), '[:value]')
+            self.assertEqual(lookup._get_namespace('a').dependencies, {'b'})
+        self.assertFalse(check.called)
+
+    def testDependencyChanged(self):
+        self.lookup().get('a/foo').render({'value': 'test'})
+        self.sources['b'] = 'def bar\n  p #arg\n'
+        fn = self.lookup().get('a/foo')
+        self.assertEqual(fn.render({'value': 'test'}),
+                         '<p><span>test</span></p>')
+
+    def testTypesChanged(self):
+        self.lookup().get('a/foo').render({'value': 'test'})
+        with patch.object(Lookup, '_check', side_effect=AssertionError):
+            with self.assertRaises(AssertionError):
+                self.lookup({'value': IntType}).get('a/foo').render({})
+
+
+C_SRC = """\
+def baz
+  a/foo
+"""
+
+
+class TestIncremental(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.mtime = 1000
+        self.write('a', A_SRC)
+        self.write('b', B_SRC)
+        self.write('c', C_SRC)
+        self.lookup = Lookup({'value': StringType},
+                             FileSystemLoader(self.path))
+
+    def write(self, name, content):
+        file_path = os.path.join(self.path, '{}.kinko'.format(name))
+        with open(file_path, 'w') as f:
+            f.write(content)
+        self.mtime += 1
+        os.utime(file_path, (self.mtime, self.mtime))
+
+    def testRecompileChanged(self):
+        fn = self.lookup.get('c/baz')
+        self.assertEqual(fn.render({'value': 'test'}),
+                         '<div><span>test</span></div>')
+        b_module = self.lookup._get_namespace('b').module
+
+        self.write('a', A_SRC.replace('span', 'em'))
+        check = self.lookup._check
+        with patch.object(self.lookup, '_check', side_effect=check) as mock:
+            self.assertEqual(fn.render({'value': 'test'}),
+                             '<div><em>test</em></div>')
+        (parsed_sources, reused), _ = mock.call_args
+        self.assertEqual({ps.name for ps in parsed_sources}, {'a', 'c'})
+        self.assertEqual(set(reused), {'b'})
+        self.assertIs(self.lookup._get_namespace('b').module, b_module)
+        self.assertEqual(repr(fn.query()), '[:value]')
+
+    def testRelink(self):
+        self.lookup.get('c/baz').render({'value': 'test'})
+        c_module = self.lookup._namespaces['c'].module
+        a_module = self.lookup._namespaces['a'].module
+        self.write('b', B_SRC.replace('div', 'p'))
+        fn = self.lookup.get('a/foo')
+        self.assertEqual(fn.render({'value': 'test'}),
+                         '<p><span>test</span></p>')
+        # modules are shared, so they are not linked with new versions
+        self.assertNotIn('c', self.lookup._namespaces)
+        self.assertIs(c_module[link_name('a/foo')], a_module['foo'])
+        self.assertEqual(self.lookup.get('c/baz').render({'value': 'test'}),
+                         '<p><span>test</span></p>')
+        new_c_module = self.lookup._namespaces['c'].module
+        new_a_module = self.lookup._namespaces['a'].module
+        self.assertIs(new_c_module[link_name('a/foo')], new_a_module['foo'])
+
+    def testEvict(self):
+        self.lookup.get('c/baz').render({'value': 'test'})
+        names = {ns.module['__name__']
+                 for ns in self.lookup._namespaces.values()}
+        self.write('b', B_SRC.replace('div', 'p'))
+        self.lookup.get('c/baz').render({'value': 'test'})
+        for name in names:
+            self.assertNotIn(name, sys.modules)
+
+    def testPreload(self):
+        with patch('kinko.lookup.gc') as gc:
+            self.lookup.preload()
+        self.assertEqual(set(self.lookup._namespaces), {'a', 'b', 'c'})
+        gc.freeze.assert_called_once_with()
+        with patch.object(self.lookup, '_compile') as compile_:
+            self.assertEqual(self.lookup.get('c/baz').render({'value': 'x'}),
+                             '<div><span>x</span></div>')
+        self.assertFalse(compile_.called)
+
+
+class TestStreaming(TestCase):
+
+    def setUp(self):
+        loader = DictLoader({
+            'a': A_SRC,
+            'b': B_SRC,
+            'c': """\
+def items
+  ul
+    each i items
+      li
+        a/foo
+""",
+        })
+        types_ = {
+            'value': StringType,
+            'items': ListType[Record[{'id': IntType}]],
+        }
+        self.lookup = Lookup(types_, loader)
+        self.result = {'value': 'test',
+                       'items': [{'id': 1}, {'id': 2}, {'id': 3}]}
+        self.content = ('<ul>' +
+                        '<li><div><span>test</span></div></li>' * 3 +
+                        '</ul>')
+
+    def testRenderTo(self):
+        chunks = []
+        fn = self.lookup.get('c/items')
+        fn.render_to(self.result, chunks.append, chunk_size=40)
+        self.assertEqual(chunks, [
+            '<ul><li><div><span>test</span></div></li>',
+            '<li><div><span>test</span></div></li><li>',
+            '<div><span>test</span></div></li></ul>',
+        ])
+        self.assertEqual(''.join(chunks), fn.render(self.result))
+
+    def testRenderIter(self):
+        fn = self.lookup.get('c/items')
+        chunks = list(fn.render_iter(self.result, chunk_size=40))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), self.content)
+
+    def testFlushedArguments(self):
+        # markup arguments are passed as thunks and written directly
+        chunks = []
+        fn = self.lookup.get('a/foo')
+        fn.render_to(self.result, chunks.append, chunk_size=1)
+        self.assertEqual(chunks, ['<div>', '<span>test</span>', '</div>'])
+
+    def testRenderIterClose(self):
+        fn = self.lookup.get('c/items')
+        result = dict(self.result, items=[{'id': i} for i in range(100)])
+        chunks = fn.render_iter(result, chunk_size=1)
+        next(chunks)
+        chunks.close()
+        # rendering thread should not stay blocked on the full queue
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
@@ -0,0 +1,44 @@
+import os.path
+import sys
+import shutil
+import tempfile
+
+from kinko.modules import module_name, path_key, import_code, import_path
+from kinko.modules import evict, PACKAGE
+
+from .base import TestCase
+
+
+class TestModules(TestCase):
+
+    def testImportCode(self):
+        name = module_name('foo/bar', '0123456789abcdef0123')
+        self.assertEqual(name, 'kinko_compiled.foo_bar_0123456789abcdef')
+        module = import_code(name, compile('def f(): pass', '<foo>', 'exec'))
+        self.assertIs(sys.modules[name], module)
+        self.assertEqual(module.f.__module__, name)
+        self.assertIs(import_code(name, compile('', '<foo>', 'exec')), module)
+
+    def testEvict(self):
+        name = module_name('foo/baz', '0123456789abcdef0123')
+        module = import_code(name, compile('x = 1', '<foo>', 'exec'))
+        evict(name)
+        self.assertNotIn(name, sys.modules)
+        package = sys.modules[PACKAGE]
+        self.assertFalse(hasattr(package, 'foo_baz_0123456789abcdef'))
+        other = import_code(name, compile('x = 2', '<foo>', 'exec'))
+        self.assertIsNot(other, module)
+        self.assertEqual(other.x, 2)
+
+    def testImportPath(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        file_path = os.path.join(tmp_dir, 'bar.py')
+        with open(file_path, 'w') as f:
+            f.write('def g(): return 1\n')
+        name = module_name('bar', path_key(file_path))
+        module = import_path(name, file_path)
+        self.assertIs(sys.modules[name], module)
+        self.assertEqual(module.g(), 1)
+        self.assertEqual(os.path.splitext(module.__file__)[0],
+                         os.path.splitext(file_path)[0])
@@ -29,10 +29,10 @@ class TestCompiler(TestCase):
                                                    second.splitlines()))))
             raise self.failureException(msg)
 
-    def assertCompiles(self, src, code, env=None):
+    def assertCompiles(self, src, code, env=None, **options):
         node = parse(src)
         node = check(node, Environ(env))
-        mod = compile_module(node)
+        mod = compile_module(node, **options)
         try:
             compile(mod, '<kinko-template>', 'exec')
         except TypeError:
@@ -41,10 +41,10 @@ class TestCompiler(TestCase):
         else:
             self.compareSources(dumps(mod), code)
 
-    def assertRenders(self, src, content, context=None, env=None):
+    def assertRenders(self, src, content, context=None, env=None, **options):
         node = parse(src)
         node = check(node, Environ(env))
-        mod = compile_module(node)
+        mod = compile_module(node, **options)
         mod_code = compile(mod, '<kinko-template>', 'exec')
 
         ctx = SimpleContext(context or {})
@@ -121,6 +121,47 @@ class TestCompiler(TestCase):
             {'items': ListType[StringType]},
         )
 
+    def testFlushPoints(self):
+        self.assertCompiles(
+            """
+            def foo
+              div
+                each i items
+                  div i
+            """,
+            """
+            def foo(ctx):
+                ctx.buffer.write('<div>')
+                for i in ctx.result['items']:
+                    ctx.buffer.write('<div>')
+                    ctx.buffer.write_unsafe(i)
+                    ctx.buffer.write('</div>')
+                    ctx.buffer.flush()
+                ctx.buffer.write('</div>')
+                ctx.buffer.flush()
+            """,
+            {'items': ListType[StringType]},
+            flush=True,
+        )
+
+    def testFormatWrites(self):
+        expr = ("""('<a href="%s">%s100%%</a>' % """
+                """(ctx.buffer.escape(i['url']), i['id']))""")
+        self.assertCompiles(
+            """
+            def foo
+              each i items
+                a :href i.url i.id "100%"
+            """,
+            """
+            def foo(ctx):
+                for i in ctx.result['items']:
+                    ctx.buffer.write({})
+            """.format(expr),
+            {'items': ListType[Record[{'url': StringType, 'id': IntType}]]},
+            format_writes=True,
+        )
+
     def testBuiltinFuncCall(self):
         self.assertCompiles(
             """
@@ -135,6 +176,133 @@ class TestCompiler(TestCase):
                              StringType]},
         )
 
+    def testHoistLocals(self):
+        self.assertCompiles(
+            """
+            def foo
+              ul
+                each i items
+                  li
+                    a :href (url-for i.name) i.name
+            """,
+            """
+            def foo(ctx):
+                _ctx_buffer_write = ctx.buffer.write
+                _ctx_result = ctx.result
+                _ctx_buffer_write_unsafe = ctx.buffer.write_unsafe
+                _ctx_builtins_url_2d_for = ctx.builtins['url-for']
+                _ctx_buffer_write('<ul>')
+                for i in _ctx_result['items']:
+                    _ctx_buffer_write('<li><a href="')
+                    _ctx_buffer_write_unsafe(_ctx_builtins_url_2d_for(i['name']))
+                    _ctx_buffer_write('">')
+                    _ctx_buffer_write_unsafe(i['name'])
+                    _ctx_buffer_write('</a></li>')
+                _ctx_buffer_write('</ul>')
+            """,
+            {'url-for': Func[[StringType], StringType],
+             'items': ListType[Record[{'name': StringType}]]},
+            hoist=True,
+        )
+
+    def testHoistConditionalBuiltins(self):
+        # missing builtin shouldn't fail, when branch is not taken
+        self.assertCompiles(
+            """
+            def foo
+              if flag
+                div (url "x")
+              each i items
+                if i (div (url i))
+            """,
+            """
+            def foo(ctx):
+                _ctx_result = ctx.result
+                _ctx_buffer_write = ctx.buffer.write
+                _ctx_buffer_write_unsafe = ctx.buffer.write_unsafe
+                if _ctx_result['flag']:
+                    _ctx_buffer_write('<div>')
+                    _ctx_buffer_write_unsafe(ctx.builtins['url']('x'))
+                    _ctx_buffer_write('</div>')
+                for i in _ctx_result['items']:
+                    if i:
+                        _ctx_buffer_write('<div>')
+                        _ctx_buffer_write_unsafe(ctx.builtins['url'](i))
+                        _ctx_buffer_write('</div>')
+            """,
+            {'url': Func[[StringType], StringType],
+             'flag': BoolType,
+             'items': ListType[StringType]},
+            hoist=True,
+        )
+
+    def testConstantFolding(self):
+        self.assertCompiles(
+            """
+            def foo
+              let [title "Hi" size 2]
+                div :class (join " " ["box" "big"])
+                  h1 title
+                  if size (p "some") (p "none")
+                  each i items
+                    span :data-size size i
+            """,
+            """
+            def foo(ctx):
+                ctx.buffer.write('<div class="box big"><h1>Hi</h1><p>some</p>')
+                for i in ctx.result['items']:
+                    ctx.buffer.write('<span data-size="2">')
+                    ctx.buffer.write_unsafe(i)
+                    ctx.buffer.write('</span>')
+                ctx.buffer.write('</div>')
+            """,
+            {'items': ListType[StringType]},
+            fold=True,
+        )
+
+    def testMergeBranches(self):
+        self.assertCompiles(
+            """
+            div
+              if flag (a :class "on" "yes") (a :class "off" "no")
+            """,
+            """
+            ctx.buffer.write('<div><a class="o')
+            if ctx.result['flag']:
+                ctx.buffer.write('n">yes')
+            else:
+                ctx.buffer.write('ff">no')
+            ctx.buffer.write('</a></div>')
+            """,
+            {'flag': BoolType},
+            fold=True,
+        )
+
+    def testMergeEqualBranches(self):
+        self.assertCompiles(
+            """
+            if flag (a "x") (a "x")
+            """,
+            """
+            ctx.buffer.write('<a>x</a>')
+            """,
+            {'flag': BoolType},
+            fold=True,
+        )
+
+    def testMergeEqualBranchesCall(self):
+        self.assertCompiles(
+            """
+            if (is-on flag) (a "x") (a "x")
+            """,
+            """
+            ctx.buffer.write('<a>x</a>')
+            ctx.builtins['is-on'](ctx.result['flag'])
+            """,
+            {'flag': BoolType, 'is-on': Func[[BoolType], BoolType]},
+            fold=True,
+        )
+
     def testFuncDef(self):
         self.assertCompiles(
             """
@@ -179,7 +347,7 @@ class TestCompiler(TestCase):
             ctx.buffer.write('<span>Test</span>')
             baz(ctx, 3, 4, param2=ctx.buffer.pop())
             ctx.buffer.write('</div>')
-            ctx.lookup('foo/bar')(ctx, 1, 2, param1=ctx.buffer.pop())
+            _l_foo_2f_bar(ctx, 1, 2, param1=ctx.buffer.pop())
             ctx.buffer.write('</div>')
             """,
             {'foo/bar': Func[[IntType, IntType, NamedArg['param1', Markup]],
@@ -188,6 +356,112 @@ class TestCompiler(TestCase):
                            Markup]},
         )
 
+    def assertInlines(self, src, code, env=None):
+        node = NamesResolver('foo').visit(parse(src))
+        node = collect_defs([node])
+        types = def_types(node)
+        types.update(env or {})
+        node = check(node, Environ(types))
+        node = NamesUnResolver('foo').visit(node)
+        mod = compile_module(node, inline=True)
+        self.compareSources(dumps(mod), code)
+
+    def testInline(self):
+        self.assertInlines(
+            """
+            def item
+              li :class #kind
+                #body
+
+            def page
+              ul
+                each i items
+                  ./item :kind i.kind :body (span i.name)
+            """,
+            """
+            def item(ctx, kind, body):
+                ctx.buffer.write('<li class="')
+                ctx.buffer.write_optional_unsafe(kind)
+                ctx.buffer.write('">')
+                ctx.buffer.write_optional_unsafe(body)
+                ctx.buffer.write('</li>')
+
+            def page(ctx):
+                ctx.buffer.write('<ul>')
+                for i in ctx.result['items']:
+                    kind__1 = i['kind']
+                    ctx.buffer.write('<li class="')
+                    ctx.buffer.write_unsafe(kind__1)
+                    ctx.buffer.write('"><span>')
+                    ctx.buffer.write_unsafe(i['name'])
+                    ctx.buffer.write('</span></li>')
+                ctx.buffer.write('</ul>')
+            """,
+            {'items': ListType[Record[{'kind': StringType,
+                                       'name': StringType}]]},
+        )
+
+    def testInlineSkip(self):
+        self.assertInlines(
+            """
+            def twice
+              div #body #body
+
+            def heading
+              h1 title
+
+            def page
+              each title items
+                ./twice :body (span title)
+                ./heading
+            """,
+            """
+            def twice(ctx, body):
+                ctx.buffer.write('<div>')
+                ctx.buffer.write_optional_unsafe(body)
+                ctx.buffer.write_optional_unsafe(body)
+                ctx.buffer.write('</div>')
+
+            def heading(ctx):
+                ctx.buffer.write('<h1>')
+                ctx.buffer.write_unsafe(ctx.result['title'])
+                ctx.buffer.write('</h1>')
+
+            def page(ctx):
+                for title in ctx.result['items']:
+                    ctx.buffer.push()
+                    ctx.buffer.write('<span>')
+                    ctx.buffer.write_unsafe(title)
+                    ctx.buffer.write('</span>')
+                    twice(ctx, body=ctx.buffer.pop())
+                    heading(ctx)
+            """,
+            {'title': StringType, 'items': ListType[StringType]},
+        )
+
+    def testThunks(self):
+        self.assertCompiles(
+            """
+            def func
+              div
+                ./bar :arg (span "Test") :body #body
+                #body
+            """,
+            """
+            def func(ctx, body):
+                ctx.buffer.write('<div>')
+
+                def _thunk0():
+                    ctx.buffer.write('<span>Test</span>')
+                bar(ctx, arg=_thunk0, body=body)
+                ctx.buffer.write_markup(body)
+                ctx.buffer.write('</div>')
+            """,
+            {'./bar': Func[[NamedArg['arg', Markup], NamedArg['body', Markup]],
+                           Markup]},
+            thunks=True,
+        )
+
     def testLetStatement(self):
         self.assertCompiles(
             """
@@ -461,7 +735,7 @@ class TestCompiler(TestCase):
 
             def func2(ctx):
                 ctx.buffer.write('<div>')
-                ctx.lookup('bar/func3')(ctx)
+                _l_bar_2f_func3(ctx)
                 ctx.buffer.write('</div>')
             """,
         )
@@ -507,3 +781,13 @@ class TestCompiler(TestCase):
                 'bar': BoolType,
             },
         )
+
+    def testCompileFolded(self):
+        src = """
+        def foo
+          let [s "<b>" n 5]
+            div :title s "<i>" s n (join ", " ["a" s])
+        """
+        content = '<div title="&lt;b&gt;"><i>&lt;b&gt;5a, &lt;b&gt;</div>'
+        self.assertRenders(src, content)
+        self.assertRenders(src, content, fold=True)
@@ -1,3 +1,5 @@
+import pickle
+
 from kinko.refs import ArgRef, RefsCollector, FieldRef, ItemRef, extract, CtxRef
 from kinko.refs import type_to_query
 from kinko.query import Edge, Field, Link
@@ -166,3 +168,36 @@ def test_requirements():
                  Edge([Field('y'),
                        Link('x', Edge([Field('count'),
                                        Field('name')]))]))
+
+
+def test_query_immutable():
+    query = Edge([Field('y'), Link('x', Edge([Field('count')]))])
+    other = Edge([Link('x', Edge([Field('count')])), Field('y')])
+    assert query == other
+    assert hash(query) == hash(other)
+    assert query != Edge([Field('y')])
+    for obj, attr in [(query, 'fields'), (query.fields['x'], 'edge'),
+                      (query.fields['y'], 'name')]:
+        try:
+            setattr(obj, attr, None)
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError('{!r} is mutable'.format(obj))
+    for method, args in [('__setitem__', ('z', Field('z'))),
+                         ('__delitem__', ('y',)), ('pop', ('y',)),
+                         ('update', ({},)), ('clear', ())]:
+        try:
+            getattr(query.fields, method)(*args)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('fields are mutable')
+    assert set(query.fields) == {'x', 'y'}
+    assert pickle.loads(pickle.dumps(query, 2)) == query
+
+
+def test_query_dumps():
+    query = Edge([Link('x', Edge([Field('count')]))])
+    assert query.dumps() == b'[{:x [:count]}]'
+    assert query.dumps() is query.dumps()
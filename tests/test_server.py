@@ -0,0 +1,73 @@
+import threading
+
+from kinko.errors import UserError
+
+from .base import TestCase, Mock
+
+try:
+    import asyncio
+    from kinko.server import use_combined
+except (ImportError, SyntaxError):
+    asyncio = None
+
+
+def _result(loop, value):
+    future = asyncio.Future(loop=loop)
+    future.set_result(value)
+    return future
+
+
+class _App(dict):
+
+    def __init__(self, loop, **settings):
+        super(_App, self).__init__(COMBINED=True, COMPILED_PATH=None,
+                                   IMMUTABLE=True, **settings)
+        self.loop = loop
+
+
+class TestCombined(TestCase):
+
+    def setUp(self):
+        if asyncio is None:
+            self.skipTest('aiohttp is not available')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.threads = []
+        self.lookup = Mock()
+        self.lookup.queries.side_effect = self.queries
+        self.backend = Mock()
+        self.backend.register.side_effect = (
+            lambda queries: _result(self.loop, True))
+        self.app = _App(self.loop, _lookup=self.lookup, _backend=self.backend)
+
+    def queries(self):
+        self.threads.append(threading.current_thread())
+        return {'a/foo': 'query'}
+
+    def use_combined(self, times=1):
+        return self.loop.run_until_complete(asyncio.gather(
+            *[use_combined(self.app) for _ in range(times)], loop=self.loop))
+
+    def testRegister(self):
+        self.assertEqual(self.use_combined(3), [True, True, True])
+        self.assertEqual(self.use_combined(), [True])
+        self.backend.register.assert_called_once_with({'a/foo': 'query'})
+        # queries are compiled outside of the event loop
+        self.assertEqual(len(self.threads), 1)
+        self.assertIsNot(self.threads[0], threading.current_thread())
+
+    def testRegisterError(self):
+        self.backend.register.side_effect = Exception('Internal Error')
+        self.assertEqual(self.use_combined(2), [False, False])
+        self.assertEqual(self.use_combined(), [False])
+        self.assertEqual(self.backend.register.call_count, 1)
+
+    def testQueriesError(self):
+        self.lookup.queries.side_effect = UserError('Syntax error')
+        self.assertEqual(self.use_combined(), [False])
+        self.assertFalse(self.backend.register.called)
+
+    def testNotImmutable(self):
+        self.app['IMMUTABLE'] = False
+        self.assertEqual(self.use_combined(), [False])
+        self.assertFalse(self.lookup.queries.called)
@@ -1,5 +1,7 @@
+from markupsafe import Markup, escape
+
 from kinko.nodes import Number, Keyword
-from kinko.utils import split_args
+from kinko.utils import split_args, Buffer, ListBuffer, escape_text
 
 from .base import TestCase, NODE_EQ_PATCHER
 
@@ -18,3 +20,40 @@ class TestUtils(TestCase):
         )
         with self.assertRaises(TypeError):
             split_args([Number(1), Keyword('foo')])
+
+
+class TestBuffers(TestCase):
+
+    def checkBuffer(self, buffer_cls):
+        buf = buffer_cls()
+        buf.push()
+        buf.write('<div>')
+        buf.write(1)
+        buf.push()
+        buf.write_unsafe('<b>')
+        buf.write_optional(None)
+        buf.write_optional_unsafe(None)
+        inner = buf.pop()
+        self.assertEqual(inner, '&lt;b&gt;')
+        buf.write(inner)
+        buf.write_optional('</div>')
+        self.assertEqual(buf.pop(), '<div>1&lt;b&gt;</div>')
+
+        buf.push()
+        buf.write_markup(lambda: buf.write('<i>'))
+        buf.write_markup('<b>')
+        buf.write_markup(None)
+        self.assertEqual(buf.render_markup(lambda: buf.write('<i>')), '<i>')
+        self.assertEqual(buf.render_markup('<b>'), '<b>')
+        self.assertEqual(buf.pop(), '<i>&lt;b&gt;')
+
+    def testEscapeText(self):
+        for value in [u'text', u'<a href="/?a=1&b=2">\'</a>', 1, None,
+                      Markup('<b>'), b'<b>']:
+            self.assertEqual(escape_text(value), escape(value))
+
+    def testBuffer(self):
+        self.checkBuffer(Buffer)
+
+    def testListBuffer(self):
+        self.checkBuffer(ListBuffer)